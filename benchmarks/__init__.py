@@ -0,0 +1,44 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Benchmarks for python-symmetric-jsonrpc.
+
+There are three levels of benchmarks, each in a module of its own:
+
+    bench_codec      encoding and decoding of payloads of different
+                     shapes, without any I/O
+    bench_transport  SocketReader and SocketWriter, and JSON values,
+                     over a socketpair
+    bench_rpc        requests per second and latency percentiles of
+                     RPCClient calls to an RPCServer, at several
+                     levels of concurrency
+
+Run them all with
+
+    python -m benchmarks.run --output results.json
+
+and compare two runs, for example from before and after a change,
+with
+
+    python -m benchmarks.run --compare old.json new.json
+"""
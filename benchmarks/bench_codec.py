@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Micro-benchmarks of encoding and decoding JSON, without I/O."""
+
+import StringIO
+
+from symmetricjsonrpc import codec, json
+
+import common
+
+def payloads():
+    """Returns the payloads to benchmark with, by name."""
+    return {
+        'envelope': {'jsonrpc': '2.0', 'method': 'ping', 'params': [1, "two", 3.0], 'id': 4711},
+        'response': {'result': {'name': "Nicklas", 'ok': True, 'items': [1, 2, 3]}, 'error': None, 'id': 4711},
+        'large_string': {'result': u"xå\"\n" * 25000, 'error': None, 'id': 1},
+        'deep_nesting': reduce(lambda value, n: {'level': n, 'next': [value]}, xrange(100), None),
+        'wide_array': {'result': [{'id': n, 'value': n * 0.5, 'name': "item %s" % n} for n in xrange(1000)],
+                       'error': None, 'id': 1},
+        'numbers': range(-5000, 5000)}
+
+def run(min_time=0.2):
+    results = []
+    for name, value in sorted(payloads().iteritems()):
+        text = json.to_json(value)
+        size = len(text)
+        def to_json():
+            json.to_json(value)
+        def from_json():
+            json.from_json(text)
+        def writer():
+            json.Writer(StringIO.StringIO(), encoding='UTF-8').write_value(value)
+        def reader():
+            json.Reader(StringIO.StringIO(text)).read_value()
+        for operation, fn in (('to_json', to_json), ('from_json', from_json),
+                              ('Writer', writer), ('Reader', reader)):
+            m = common.measure(fn, min_time)
+            results.append(common.result('codec', '%s/%s' % (operation, name),
+                                         bytes=size, bytes_per_sec=size * m['calls_per_sec'], **m))
+        for codec_class in (codec.PythonCodec, codec.StdlibCodec):
+            c = codec_class()
+            encoded = c.encode(value)
+            m = common.measure(lambda: c.encode(value), min_time)
+            results.append(common.result('codec', '%s.encode/%s' % (codec_class.__name__, name),
+                                         bytes=size, bytes_per_sec=size * m['calls_per_sec'], **m))
+            m = common.measure(lambda: c.decode(encoded), min_time)
+            results.append(common.result('codec', '%s.decode/%s' % (codec_class.__name__, name),
+                                         bytes=size, bytes_per_sec=size * m['calls_per_sec'], **m))
+    # Reading strings should take time linear in their length, so
+    # bytes_per_sec should stay about the same for all of these.
+    chunk = 'x' * 62 + '\\n'
+    for size in (10000, 100000, 1000000, 10000000):
+        text = '"%s"' % (chunk * (size / len(chunk)),)
+        def reader():
+            json.Reader(text).read_value()
+        m = common.measure(reader, min_time, repeat=1)
+        results.append(common.result('codec', 'Reader/long_string_%s' % size,
+                                     bytes=len(text), bytes_per_sec=len(text) * m['calls_per_sec'], **m))
+    return results
+
+if __name__ == "__main__":
+    print '\n'.join(common.report(run()))
@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""End-to-end benchmarks of RPCClient calls to a server."""
+
+import socket
+import threading
+import time
+
+from symmetricjsonrpc import methods, reactor, rpc
+
+import common
+
+registry = methods.MethodRegistry()
+
+@registry.register
+def echo(value):
+    return value
+
+def _server_socket():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(('localhost', 0))
+    s.listen(128)
+    return s
+
+def threaded_server(s):
+    server = rpc.RPCServer(s, name="BenchmarkServer", methods=registry)
+    def stop():
+        server.shutdown()
+        server.join()
+    return stop
+
+def reactor_server(s):
+    r = reactor.Reactor().start()
+    server = reactor.ReactorServer(r, s, rpc.RPCServer, methods=registry)
+    def stop():
+        server.shutdown()
+        server.join(5)
+        r.stop()
+        r.thread.join()
+        r.close()
+    return stop
+
+def calls(start_server, concurrency, duration, value="ping"):
+    """Returns a result for concurrency clients, each calling echo
+    as fast as it can over a connection of its own for duration
+    seconds."""
+    s = _server_socket()
+    address = s.getsockname()
+    stop = start_server(s)
+    clients = [rpc.RPCClient(socket.create_connection(address)) for n in xrange(concurrency)]
+    latencies = [[] for client in clients]
+    ready = threading.Event()
+    def run(client, samples):
+        ready.wait()
+        end = time.time() + duration
+        now = time.time()
+        while now < end:
+            client.echo(value)
+            then, now = now, time.time()
+            samples.append(now - then)
+    threads = [threading.Thread(target=run, args=args) for args in zip(clients, latencies)]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    ready.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    for client in clients:
+        client.shutdown()
+    stop()
+    samples = sum(latencies, [])
+    values = common.percentiles([sample * 1000 for sample in samples])
+    values = dict(('latency_%s_ms' % key, value) for key, value in values.iteritems())
+    return common.result('rpc', '%s/%s' % (start_server.__name__, concurrency),
+                         requests=len(samples), seconds=elapsed,
+                         requests_per_sec=len(samples) / elapsed, **values)
+
+def run(duration=2.0, concurrencies=(1, 4, 16)):
+    results = []
+    for start_server in (threaded_server, reactor_server):
+        for concurrency in concurrencies:
+            results.append(calls(start_server, concurrency, duration))
+    return results
+
+if __name__ == "__main__":
+    print '\n'.join(common.report(run()))
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Benchmarks of reading and writing over a socketpair."""
+
+import socket
+import threading
+import time
+
+from symmetricjsonrpc import codec, framing, json, wrappers
+
+import common
+
+def _transfer(write, read):
+    """Runs write() in a thread of its own while read() runs in this
+    one, and returns the seconds it took."""
+    errors = []
+    def writer():
+        try:
+            write()
+        except Exception, e:
+            errors.append(e)
+    thread = threading.Thread(target=writer)
+    start = time.time()
+    thread.start()
+    read()
+    elapsed = time.time() - start
+    thread.join()
+    if errors:
+        raise errors[0]
+    return elapsed
+
+def raw(chunk_size, total):
+    """Returns a result for writing total bytes in chunks of
+    chunk_size with SocketWriter, and reading them with
+    SocketReader."""
+    a, b = socket.socketpair()
+    chunk = 'x' * chunk_size
+    count = total // chunk_size
+    def write():
+        writer = wrappers.WriterWrapper(a)
+        for n in xrange(count):
+            writer.write(chunk)
+        writer.flush()
+    def read():
+        reader = wrappers.ReaderWrapper(b)
+        left = count * chunk_size
+        while left:
+            left -= len(reader.read_chunk())
+    try:
+        elapsed = _transfer(write, read)
+    finally:
+        a.close()
+        b.close()
+    return common.result('transport', 'raw/%s' % chunk_size,
+                         bytes=count * chunk_size, seconds=elapsed,
+                         bytes_per_sec=count * chunk_size / elapsed)
+
+def values(name, c, value, count):
+    """Returns a result for writing count copies of value with the
+    codec c, and reading them back."""
+    a, b = socket.socketpair()
+    def write():
+        writer = c.writer(a)
+        for n in xrange(count):
+            writer.write_value(value)
+    def read():
+        reader = c.reader(b)
+        n = 0
+        for v in reader.read_values():
+            n += 1
+            if n == count:
+                break
+    try:
+        elapsed = _transfer(write, read)
+    finally:
+        a.close()
+        b.close()
+    return common.result('transport', 'values/%s' % name,
+                         messages=count, seconds=elapsed, messages_per_sec=count / elapsed)
+
+def run(scale=1.0):
+    results = []
+    for chunk_size in (64, 4096, 65536):
+        results.append(raw(chunk_size, int(16 * 1024 * 1024 * scale)))
+    envelope = {'jsonrpc': '2.0', 'method': 'ping', 'params': [1, "two", 3.0], 'id': 4711}
+    count = max(10, int(5000 * scale))
+    results.append(values('PythonCodec', codec.PythonCodec(), envelope, count))
+    results.append(values('PythonCodec/LineFramer', codec.PythonCodec(framer_class=framing.LineFramer),
+                          envelope, count))
+    results.append(values('StdlibCodec', codec.StdlibCodec(), envelope, count))
+    results.append(values('StdlibCodec/LengthPrefixFramer',
+                          codec.StdlibCodec(framer_class=framing.LengthPrefixFramer), envelope, count))
+    return results
+
+if __name__ == "__main__":
+    print '\n'.join(common.report(run()))
@@ -0,0 +1,151 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Timing and result handling shared by the benchmarks."""
+
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+def measure(fn, min_time=0.2, repeat=3):
+    """Calls fn repeatedly, in repeat rounds of at least min_time
+    seconds each, and returns the number of calls per second and the
+    seconds per call in the fastest round."""
+    number = 1
+    while True:
+        elapsed = _time(fn, number)
+        if elapsed >= min_time:
+            break
+        number *= max(2, min(10, int(min_time / max(elapsed, 1e-9)) + 1))
+    best = elapsed
+    for n in xrange(repeat - 1):
+        best = min(best, _time(fn, number))
+    return {'calls_per_sec': number / best,
+            'sec_per_call': best / number}
+
+def _time(fn, number):
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.time()
+        for n in xrange(number):
+            fn()
+        return time.time() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def percentiles(samples, ps=(50, 90, 99, 99.9)):
+    """Returns a dictionary of the percentiles ps of samples, keyed
+    like 'p50'."""
+    samples = sorted(samples)
+    result = {}
+    for p in ps:
+        if samples:
+            value = samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+        else:
+            value = None
+        result['p%s' % ('%g' % p).replace('.', '_')] = value
+    return result
+
+def result(group, name, **values):
+    """Returns a benchmark result."""
+    values['group'] = group
+    values['name'] = name
+    return values
+
+def _revision():
+    try:
+        process = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        output = process.communicate()[0].strip()
+        if process.returncode == 0:
+            return output
+    except OSError:
+        pass
+    return None
+
+def save(results, path):
+    """Writes results to the file path as JSON, together with a
+    description of the environment they were measured in."""
+    document = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'revision': _revision(),
+                         'python': sys.version,
+                         'platform': platform.platform(),
+                         'machine': platform.machine()},
+                'results': results}
+    f = open(path, 'w')
+    try:
+        json.dump(document, f, indent=2, sort_keys=True)
+        f.write('\n')
+    finally:
+        f.close()
+
+def load(path):
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+# Whether a larger value of a measurement is better
+_higher_is_better = ('calls_per_sec', 'bytes_per_sec', 'messages_per_sec', 'requests_per_sec')
+
+# Values describing the work done rather than measuring it
+_not_compared = ('group', 'name', 'bytes', 'messages', 'requests', 'seconds')
+
+def compare(old, new):
+    """Returns lines comparing the measurements of two saved runs."""
+    old_results = dict(((r['group'], r['name']), r) for r in old['results'])
+    lines = ["%-40s %-18s %14s %14s %8s" % ("benchmark", "measurement", "old", "new", "change")]
+    for r in new['results']:
+        previous = old_results.get((r['group'], r['name']))
+        if previous is None:
+            continue
+        for key in sorted(r):
+            if key in _not_compared or not isinstance(r[key], (int, long, float)):
+                continue
+            if not isinstance(previous.get(key), (int, long, float)) or not previous[key]:
+                continue
+            change = (r[key] - previous[key]) / float(previous[key]) * 100
+            if key not in _higher_is_better:
+                # Report changes in latencies so that positive is
+                # better too.
+                change = 0.0 - change
+            lines.append("%-40s %-18s %14.6g %14.6g %+7.1f%%" % (
+                "%s/%s" % (r['group'], r['name']), key, previous[key], r[key], change))
+    return lines
+
+def report(results):
+    """Returns lines describing results."""
+    lines = []
+    for r in results:
+        values = ', '.join('%s=%.6g' % (key, r[key]) for key in sorted(r)
+                           if key not in ('group', 'name') and isinstance(r[key], (int, long, float)))
+        lines.append("%s/%s: %s" % (r['group'], r['name'], values))
+    return lines
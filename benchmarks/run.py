@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Runs the benchmarks, or compares two saved runs. See the package
+documentation."""
+
+import optparse
+import sys
+
+import bench_codec
+import bench_rpc
+import bench_transport
+import common
+
+def main(args=None):
+    parser = optparse.OptionParser(usage="%prog [options]\n       %prog --compare OLD NEW")
+    parser.add_option("-o", "--output", metavar="PATH",
+                      help="save the results to PATH as JSON")
+    parser.add_option("-q", "--quick", action="store_true", default=False,
+                      help="measure for a shorter time, less precisely")
+    parser.add_option("--only", metavar="GROUPS", default="codec,transport,rpc",
+                      help="comma separated groups to run [%default]")
+    parser.add_option("-c", "--compare", action="store_true", default=False,
+                      help="compare the saved runs OLD and NEW instead")
+    options, args = parser.parse_args(args)
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare takes two saved runs")
+        print '\n'.join(common.compare(common.load(args[0]), common.load(args[1])))
+        return 0
+    if args:
+        parser.error("unexpected arguments")
+
+    scale = options.quick and 0.25 or 1.0
+    groups = {'codec': lambda: bench_codec.run(min_time=0.2 * scale),
+              'transport': lambda: bench_transport.run(scale=scale),
+              'rpc': lambda: bench_rpc.run(duration=2.0 * scale)}
+    results = []
+    for group in options.only.split(','):
+        if group not in groups:
+            parser.error("unknown group %s" % group)
+        group_results = groups[group]()
+        print '\n'.join(common.report(group_results))
+        sys.stdout.flush()
+        results.extend(group_results)
+    if options.output:
+        common.save(results, options.output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
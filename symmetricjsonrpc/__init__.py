@@ -26,20 +26,56 @@
 from __future__ import with_statement
 
 from json import *
+from codec import Codec, PythonCodec, StdlibCodec
+from framing import Framer, LengthPrefixFramer, LineFramer, StreamFramer
 from dispatcher import *
+from methods import InvalidParams, MethodNotFound, MethodRegistry
+from metrics import Metrics
 from rpc import *
+from pool import RPCClientPool
+from prefork import PreforkServer
+from profiling import PrintHook, ProfileHook, SamplingProfiler
+from timers import TimerWheel
+from reactor import Listener, Protocol, RPCProtocol, Reactor, ReactorServer, Transport
 
-__all__ = ["ClientConnection",
+__all__ = ["Batch",
+           "ClientConnection",
+           "Codec",
            "Connection",
+           "Framer",
+           "IncrementalReader",
+           "InvalidParams",
+           "LengthPrefixFramer",
+           "LineFramer",
+           "Listener",
+           "MethodNotFound",
+           "MethodRegistry",
+           "Metrics",
+           "PreforkServer",
+           "PrintHook",
+           "ProfileHook",
+           "Protocol",
+           "PythonCodec",
            "RPCClient",
+           "RPCClientPool",
+           "RPCError",
            "RPCP2PNode",
+           "RPCProtocol",
            "RPCServer",
+           "Reactor",
+           "ReactorServer",
            "Reader",
+           "RequestTimeout",
            "ServerConnection",
+           "SamplingProfiler",
            "ShutDownThread",
+           "StdlibCodec",
+           "StreamFramer",
            "Thread",
            "ThreadedClient",
+           "TimerWheel",
            "Tokenizer",
+           "Transport",
            "Writer",
            "from_json",
            "to_json"]
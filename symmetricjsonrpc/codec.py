@@ -0,0 +1,322 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Codecs translating between Python values and JSON messages on a
+transport.
+
+A codec is shared by all connections using it, and creates a reader
+and a writer for each connection. The reader provides read_values(),
+the writer write_value(), and both close(), just like json.Reader and
+json.Writer, which are what PythonCodec uses."""
+
+import inspect
+import itertools
+import os
+import sys
+import unittest
+
+import framing
+import json
+import wrappers
+
+def _import_stdlib_json():
+    # Our json module hides the one of the standard library, both
+    # from implicit relative imports and, when a module is run from
+    # this directory, from absolute ones.
+    here = os.path.dirname(os.path.abspath(__file__))
+    saved_path = sys.path[:]
+    saved_module = sys.modules.get('json')
+    if saved_module is not None and hasattr(saved_module, 'JSONEncoder'):
+        return saved_module
+    sys.modules.pop('json', None)
+    sys.path[:] = [path for path in sys.path if os.path.abspath(path or '.') != here]
+    try:
+        return __import__('json', {}, {}, [], 0)
+    finally:
+        sys.path[:] = saved_path
+        if saved_module is not None:
+            sys.modules['json'] = saved_module
+
+stdjson = _import_stdlib_json()
+
+class Codec(object):
+    """Base class for codecs.
+
+    Subclasses must implement encode() and decode(). Messages are
+    delimited on the wire by a framer, created from framer_class for
+    each connection."""
+
+    framer_class = framing.StreamFramer
+
+    def __init__(self, object_initializer = None, framer_class = None):
+        self.object_initializer = object_initializer
+        if framer_class is not None:
+            self.framer_class = framer_class
+
+    def encode(self, value):
+        """Returns the JSON text for value."""
+        raise NotImplementedError
+
+    def decode(self, text):
+        """Returns the value for the JSON text of a single message."""
+        raise NotImplementedError
+
+    def framer(self):
+        return self.framer_class()
+
+    def reader(self, s):
+        return CodecReader(s, self)
+
+    def writer(self, s):
+        return CodecWriter(s, self)
+
+class CodecReader(object):
+    """Reads messages from a socket, file-like object or string,
+    splitting them with the framer of a codec and decoding each one
+    with the codec."""
+
+    def __init__(self, s, codec):
+        self.codec = codec
+        self.closable = wrappers.ReaderWrapper(s)
+        self.s = wrappers.Cursor(self.closable)
+        self.framer = codec.framer()
+        self.texts = []
+
+    def close(self):
+        self.closable.close()
+
+    def read_texts(self):
+        """Returns an iterator over the undecoded texts of the
+        messages."""
+        while True:
+            while self.texts:
+                yield self.texts.pop(0)
+            try:
+                chunk = self.s.read_chunk()
+            except StopIteration:
+                self.texts.extend(self.framer.close())
+                while self.texts:
+                    yield self.texts.pop(0)
+                return
+            self.texts.extend(self.framer.split(chunk))
+
+    def read_values(self):
+        for text in self.read_texts():
+            yield self.codec.decode(text)
+
+    def read_value(self):
+        for value in self.read_values():
+            return value
+        raise EOFError()
+
+class CodecWriter(object):
+    """Writes messages to a socket or file-like object, encoding them
+    with a codec and framing them with its framer."""
+
+    def __init__(self, s, codec):
+        self.codec = codec
+        self.s = wrappers.WriterWrapper(s)
+        self.framer = codec.framer()
+
+    def close(self):
+        self.s.close()
+
+    def write_value(self, value):
+        self.unflushed_write_value(value)
+        self.s.flush()
+
+    def unflushed_write_value(self, value):
+        self.s.write(self.encode(value))
+
+    def encode(self, value):
+        """Returns the encoded and framed text for value."""
+        return self.framer.frame(self.codec.encode(value))
+
+    def write_encoded(self, texts):
+        """Writes and flushes a list of values already encoded with
+        encode()."""
+        self.s.writelines(texts)
+        self.s.flush()
+
+class PythonCodec(Codec):
+    """A codec using the pure Python json.Reader and json.Writer.
+
+    Unless another framer is used, values are parsed straight from the
+    stream as it is read, without looking for their ends first."""
+
+    def __init__(self, object_initializer = None, framer_class = None, encoding = None):
+        Codec.__init__(self, object_initializer, framer_class)
+        self.encoding = encoding
+
+    def encode(self, value):
+        return json.Writer(None, self.encoding).encode(value)
+
+    def decode(self, text):
+        return json.Reader(text, self.object_initializer).read_value()
+
+    def reader(self, s):
+        if self.framer_class is framing.StreamFramer:
+            return json.Reader(s, self.object_initializer)
+        return Codec.reader(self, s)
+
+    def writer(self, s):
+        if self.framer_class is framing.StreamFramer:
+            return json.Writer(s, self.encoding)
+        return Codec.writer(self, s)
+
+class StdlibCodec(Codec):
+    """A codec using the C accelerated encoder and scanner of the
+    json module in the standard library.
+
+    Objects with a __to_json__ method and types registered with
+    json.Writer.register() are encoded just as json.Writer does, and
+    __jsonclass__ objects are decoded just as json.Reader does. As the
+    encoder of the standard library encodes subclasses of dict, list,
+    tuple, strings and numbers itself, values are first walked in
+    Python to convert any such objects."""
+
+    # Types that are encoded as they are, and hold no other values.
+    _scalar_types = frozenset([unicode, str, int, long, float, bool, type(None)])
+
+    def __init__(self, object_initializer = None, framer_class = None, encoding = 'utf-8'):
+        Codec.__init__(self, object_initializer, framer_class)
+        self._encoder = stdjson.JSONEncoder(separators=(',', ':'),
+                                            default=self._default,
+                                            encoding=encoding)
+        object_hook = None
+        if object_initializer:
+            object_hook = self._object_hook
+        self._decoder = stdjson.JSONDecoder(object_hook=object_hook)
+
+    def _convert(self, value, plain):
+        # Returns value with the objects json.Writer would convert
+        # converted, and other containers as dicts and lists. plain
+        # is the set of scalar types that need no conversion.
+        t = type(value)
+        converters = json.Writer.converters
+        if t in plain:
+            return value
+        if t not in converters:
+            if t is dict:
+                if plain.issuperset(itertools.imap(type, value.itervalues())):
+                    return value
+                return dict((key, self._convert(item, plain)) for key, item in value.iteritems())
+            if t is list or t is tuple:
+                if plain.issuperset(itertools.imap(type, value)):
+                    return value
+                return [self._convert(item, plain) for item in value]
+        if hasattr(t, '__mro__'):
+            for base in inspect.getmro(t):
+                if base in converters:
+                    return self._convert(converters[base](value), plain)
+        if hasattr(value, '__to_json__'):
+            return self._convert(value.__to_json__(), plain)
+        if isinstance(value, tuple(self._scalar_types)):
+            return value
+        if hasattr(value, '__iter__'):
+            if hasattr(value, 'iteritems'):
+                return dict((key, self._convert(item, plain)) for key, item in value.iteritems())
+            return [self._convert(item, plain) for item in value]
+        return value
+
+    def _default(self, value):
+        raise TypeError("Cannot encode %s of type %s to json" % (value, type(value)))
+
+    def _object_hook(self, obj):
+        if '__jsonclass__' in obj and obj['__jsonclass__'][0] in self.object_initializer:
+            cls = obj.pop('__jsonclass__')
+            return self.object_initializer[cls[0]](cls[1:], obj)
+        return obj
+
+    def encode(self, value):
+        plain = self._scalar_types.difference(json.Writer.converters)
+        return self._encoder.encode(self._convert(value, plain))
+
+    def decode(self, text):
+        return self._decoder.decode(text)
+
+
+#### Test code ####
+
+class TestCodec(unittest.TestCase):
+    import socket
+
+    OBJ = {u"array": [u"str\xe5ng\n", False, None, 1.5, -17],
+           u"object": {u"number": 4711, u"bool": True}}
+
+    def codecs(self):
+        return [PythonCodec(), StdlibCodec()]
+
+    def test_round_trip(self):
+        for codec in self.codecs():
+            for other in self.codecs():
+                self.assertEqual(other.decode(codec.encode(self.OBJ)), self.OBJ)
+
+    def test_socket(self):
+        for codec in self.codecs():
+            sockets = self.socket.socketpair()
+            writer = codec.writer(sockets[1])
+            for n in xrange(3):
+                writer.write_value(self.OBJ)
+            writer.write_value(4711)
+            writer.close()
+            reader = codec.reader(sockets[0])
+            self.assertEqual(list(reader.read_values()), [self.OBJ] * 3 + [4711])
+
+    def test_object(self):
+        class SomeObj(object):
+            def __init__(self, x):
+                self.x = x
+            def __to_json__(self):
+                return {'__jsonclass__': ['SomeObj'], 'x': self.x}
+        def some_obj(params, kw):
+            return SomeObj(kw['x'])
+        for codec in (PythonCodec({'SomeObj': some_obj}), StdlibCodec({'SomeObj': some_obj})):
+            obj = codec.decode(codec.encode([SomeObj(4711)]))
+            self.assertEqual(type(obj[0]), SomeObj)
+            self.assertEqual(obj[0].x, 4711)
+            self.assertEqual(codec.decode('{"__jsonclass__":["Other"]}'), {"__jsonclass__": ["Other"]})
+
+    def test_builtin_subclasses(self):
+        class Dict(dict):
+            def __to_json__(self):
+                return {'dict': self.items()}
+        class Int(int):
+            pass
+        class Str(str):
+            pass
+        class Registered(list):
+            pass
+        json.Writer.register(Int, lambda value: "int %s" % int(value))
+        json.Writer.register(Registered, lambda value: {'length': len(value)})
+        try:
+            value = [Dict(a=1), {'b': (Int(2), Str("c"))}, Registered([3, 4]), True]
+            expected = [{'dict': [['a', 1]]}, {'b': ["int 2", "c"]}, {'length': 2}, True]
+            for codec in self.codecs():
+                self.assertEqual(codec.decode(codec.encode(value)), expected)
+        finally:
+            del json.Writer.converters[Int]
+            del json.Writer.converters[Registered]
+
+if __name__ == "__main__":
+    unittest.main()
@@ -26,8 +26,12 @@ synchronous I/O interface."""
 
 from __future__ import with_statement
 
+import Queue
 import select
 import threading
+import traceback
+
+import futures
 
 class Thread(threading.Thread):
     """This class is the base class for a set of threading.Thread
@@ -36,12 +40,45 @@ class Thread(threading.Thread):
     possibly a child/parent relationship with another thread."""
 
     debug_thread = False
+    _inline_done = None
 
     def __init__(self, subject, parent=None, *arg, **kw):
         self._init(subject=subject, parent=parent, *arg, **kw)
         self.start()
         self.run_parent()
 
+    @classmethod
+    def run_inline(cls, subject, parent=None, *arg, **kw):
+        """Like instantiating the class, but runs it in the calling
+        thread instead of starting a new one. The instance is still a
+        child of parent while it runs, and can be joined."""
+        self = cls.prepare_inline(subject=subject, parent=parent, *arg, **kw)
+        self.run_prepared()
+        return self
+
+    @classmethod
+    def prepare_inline(cls, subject, parent=None, *arg, **kw):
+        """Returns an instance to be run by calling its run_prepared()
+        method, possibly from another thread. The instance is a child
+        of parent, and can be joined, from the start."""
+        self = cls.__new__(cls)
+        self._init(subject=subject, parent=parent, *arg, **kw)
+        self._inline_done = threading.Event()
+        return self
+
+    def run_prepared(self):
+        try:
+            self.run()
+            self.run_parent()
+        finally:
+            self._inline_done.set()
+
+    def join(self, timeout=None):
+        if self._inline_done is not None:
+            self._inline_done.wait(timeout)
+        else:
+            threading.Thread.join(self, timeout)
+
     def _init(self, subject, parent=None, *arg, **kw):
         self.children = []
         self.subject = subject
@@ -82,13 +119,96 @@ class Thread(threading.Thread):
     def run_thread(self, *arg, **kw):
         pass
 
+class ThreadPool(object):
+    """A pool of at most max_workers worker threads running submitted
+    calls. Workers are started as needed. Up to max_queue calls (any
+    number, if max_queue is 0) wait for a free worker; beyond that,
+    submit() blocks."""
+
+    def __init__(self, max_workers=16, max_queue=0, name=None):
+        self.max_workers = max_workers
+        self.name = name or type(self).__name__
+        self.queue = Queue.Queue(max_queue)
+        self.workers = []
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *arg, **kw):
+        """Schedules fn(*arg, **kw) to be run by a worker, and
+        returns a futures.Future for its result."""
+        return self._submit(True, fn, arg, kw)
+
+    def try_submit(self, fn, *arg, **kw):
+        """Like submit(), but returns None instead of blocking if
+        the queue is full."""
+        return self._submit(False, fn, arg, kw)
+
+    def _submit(self, block, fn, arg, kw):
+        future = futures.Future()
+        with self._lock:
+            if not self._idle and len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self._work,
+                                          name="%s/%s" % (self.name, len(self.workers)))
+                worker.setDaemon(True)
+                self.workers.append(worker)
+                self._idle += 1
+                worker.start()
+            self._idle -= 1
+        try:
+            self.queue.put((future, fn, arg, kw), block)
+        except Queue.Full:
+            with self._lock:
+                self._idle += 1
+            return None
+        return future
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, fn, arg, kw = item
+            try:
+                future.set_result(fn(*arg, **kw))
+            except Exception, e:
+                traceback.print_exc()
+                future.set_exception(e)
+            with self._lock:
+                self._idle += 1
+
+    def shutdown(self, wait=True):
+        """Stops the workers once all calls submitted so far have been
+        run."""
+        for worker in self.workers:
+            self.queue.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
 class Connection(Thread):
-    """A connection manager thread base class."""
+    """A connection manager thread base class.
+
+    Each value read is dispatched to a new instance of the dispatcher
+    class, which normally runs in a thread of its own. If a
+    dispatch_executor (such as a ThreadPool) is given as a keyword
+    argument, set as a class attribute, or set on a parent connection,
+    the dispatchers are instead run inline by the workers of the
+    executor, which bounds the number of threads used."""
 
     debug_dispatch = False
+    dispatch_executor = None
 
     _dispatcher_class = "Request"
 
+    def _init(self, subject, parent=None, *arg, **kw):
+        if 'dispatch_executor' in kw:
+            self.dispatch_executor = kw.pop('dispatch_executor')
+        Thread._init(self, subject=subject, parent=parent, *arg, **kw)
+        ancestor = parent
+        while self.dispatch_executor is None and ancestor is not None:
+            self.dispatch_executor = getattr(ancestor, 'dispatch_executor', None)
+            ancestor = getattr(ancestor, 'parent', None)
+
     def run_thread(self):
         for value in self.read():
             if self.debug_dispatch: print "%s: DISPATCH: %s" % (self.getName(), value)
@@ -98,8 +218,24 @@ class Connection(Thread):
     def read(self):
         pass
 
-    def dispatch(self, subject):
-        getattr(self, self._dispatcher_class)(parent=self, subject=subject)
+    def dispatch(self, subject, **kw):
+        """Dispatches subject. Any keyword arguments are passed on to
+        the dispatcher class."""
+        dispatcher_class = getattr(self, self._dispatcher_class)
+        if self.dispatch_executor is None:
+            dispatcher_class(parent=self, subject=subject, **kw)
+        elif hasattr(dispatcher_class, 'prepare_inline'):
+            # Prepared here rather than by the worker, so that the
+            # dispatcher is a child, and joined by _exit(), while it
+            # is queued.
+            self.dispatch_executor.submit(dispatcher_class.prepare_inline(parent=self, subject=subject, **kw).run_prepared)
+        else:
+            self.dispatch_executor.submit(dispatcher_class, parent=self, subject=subject, **kw)
+
+    def dispatch_inline(self, subject, **kw):
+        """Dispatches subject in the calling thread."""
+        dispatcher_class = getattr(self, self._dispatcher_class)
+        getattr(dispatcher_class, 'run_inline', dispatcher_class)(parent=self, subject=subject, **kw)
 
 class ServerConnection(Connection):
     """Connection manager thread handling a listening socket,
@@ -107,6 +243,12 @@ class ServerConnection(Connection):
 
     _dispatcher_class = "InboundConnection"
 
+    def dispatch(self, subject, **kw):
+        """Inbound connections last as long as their sockets, so each
+        gets threads of its own instead of tying up a worker of the
+        dispatch_executor. Their own dispatchers use the executor."""
+        getattr(self, self._dispatcher_class)(parent=self, subject=subject, **kw)
+
     def read(self):
         poll = select.poll()
         poll.register(self.subject, select.POLLIN)
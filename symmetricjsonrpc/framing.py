@@ -0,0 +1,310 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Framers finding the boundaries between messages in a stream of
+data.
+
+A framer is created per connection. Its split() method is fed the data
+as it arrives and returns the text of every message completed by it,
+its close() method returns any message completed by the end of the
+stream, and its frame() method returns the text to send for a
+message.
+
+StreamFramer handles plain concatenated JSON values, the default for
+compatibility with other peers. LineFramer (newline delimited JSON)
+and LengthPrefixFramer can be used when both peers are configured to
+use them, and let messages be split without scanning their content."""
+
+import re
+import struct
+import unittest
+
+class FramingError(ValueError):
+    """Raised by split() for data that can not be framed. The
+    connection can not be read any further."""
+
+class Framer(object):
+    """Base class for framers."""
+
+    def split(self, data):
+        """Returns a list of the texts of all messages completed by
+        data."""
+        raise NotImplementedError
+
+    def close(self):
+        """Signals the end of the stream. Returns a list of the texts
+        of any messages completed by it."""
+        return []
+
+    def frame(self, text):
+        """Returns the data to send for the message text."""
+        return text
+
+class StreamFramer(Framer):
+    """Finds the end of each top level JSON value in an unframed
+    stream of concatenated values, without parsing them.
+
+    This is done by a resumable scan for brackets, quotes and escapes
+    only, so values can be split at any point between calls to
+    split()."""
+
+    _IDLE, _CONTAINER, _STRING, _LITERAL, _NUMBER = range(5)
+
+    _space_re = re.compile(r'[ \t\r\n]*')
+    _structural_re = re.compile(r'[][{}"]')
+    _string_re = re.compile(r'["\\]')
+    _number_re = re.compile(r'[-+0-9.eE]*')
+    _literals = {'t': 4, 'f': 5, 'n': 4}
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._parts = []
+        self._state = self._IDLE
+        self._depth = 0
+        self._remaining = 0
+        self._escape = False
+
+    def split(self, data):
+        """Returns a list of the texts of all top level values
+        completed by data."""
+        texts = []
+        state = self._state
+        depth = self._depth
+        pos = start = 0
+        end = len(data)
+        while pos < end:
+            complete = False
+            if state == self._IDLE:
+                pos = self._space_re.match(data, pos).end()
+                if pos == end:
+                    break
+                start = pos
+                c = data[pos]
+                if c == '{' or c == '[':
+                    state = self._CONTAINER
+                    depth = 1
+                    pos += 1
+                elif c == '"':
+                    state = self._STRING
+                    depth = 0
+                    pos += 1
+                elif c in self._literals:
+                    state = self._LITERAL
+                    self._remaining = self._literals[c]
+                else:
+                    state = self._NUMBER
+            elif state == self._CONTAINER:
+                m = self._structural_re.search(data, pos)
+                if m is None:
+                    pos = end
+                else:
+                    pos = m.end()
+                    c = m.group()
+                    if c == '"':
+                        state = self._STRING
+                    elif c == '{' or c == '[':
+                        depth += 1
+                    else:
+                        depth -= 1
+                        complete = depth == 0
+            elif state == self._STRING:
+                if self._escape:
+                    self._escape = False
+                    pos += 1
+                    continue
+                m = self._string_re.search(data, pos)
+                if m is None:
+                    pos = end
+                elif m.group() == '\\':
+                    self._escape = True
+                    pos = m.end()
+                else:
+                    pos = m.end()
+                    if depth:
+                        state = self._CONTAINER
+                    else:
+                        complete = True
+            elif state == self._LITERAL:
+                n = min(self._remaining, end - pos)
+                pos += n
+                self._remaining -= n
+                complete = not self._remaining
+            else:
+                number_end = self._number_re.match(data, pos).end()
+                if number_end == pos and pos == start and not self._parts:
+                    # Not a valid value at all; hand the offending
+                    # character to decode() to have it fail.
+                    pos += 1
+                    complete = True
+                else:
+                    pos = number_end
+                    complete = pos < end
+            if complete:
+                self._parts.append(data[start:pos])
+                texts.append(''.join(self._parts))
+                self._parts = []
+                state = self._IDLE
+        if state != self._IDLE:
+            self._parts.append(data[start:])
+        self._state = state
+        self._depth = depth
+        return texts
+
+    def close(self):
+        """Returns a list holding the text of the last value if it
+        was a number, as those have no terminating character. Any
+        other incomplete value is discarded."""
+        texts = []
+        if self._state == self._NUMBER:
+            texts.append(''.join(self._parts))
+        self._reset()
+        return texts
+
+class LineFramer(Framer):
+    """Newline delimited JSON: every message is sent on a line of its
+    own. Blank lines are ignored.
+
+    The encoders in this package never put raw newlines in the JSON
+    they produce, so any of them can be used with this framer."""
+
+    def __init__(self):
+        self._parts = []
+
+    def split(self, data):
+        texts = []
+        pos = 0
+        while True:
+            end = data.find('\n', pos)
+            if end == -1:
+                break
+            self._parts.append(data[pos:end])
+            text = ''.join(self._parts)
+            if text.strip():
+                texts.append(text)
+            self._parts = []
+            pos = end + 1
+        if pos < len(data):
+            self._parts.append(data[pos:])
+        return texts
+
+    def close(self):
+        text = ''.join(self._parts)
+        self._parts = []
+        if text.strip():
+            return [text]
+        return []
+
+    def frame(self, text):
+        return text + '\n'
+
+class LengthPrefixFramer(Framer):
+    """Every message is preceded by a header holding its length in
+    bytes as a 32 bit unsigned integer in network byte order.
+
+    Messages that are empty or longer than max_length bytes are
+    rejected with a FramingError as soon as their header is read."""
+
+    header = struct.Struct('!I')
+    max_length = 16 * 1024 * 1024
+
+    def __init__(self, max_length=None):
+        if max_length is not None:
+            self.max_length = max_length
+        self._parts = []
+        self._length = 0
+        self._need = None
+
+    def split(self, data):
+        self._parts.append(data)
+        self._length += len(data)
+        texts = []
+        if self._length < (self._need or self.header.size):
+            return texts
+        buff = ''.join(self._parts)
+        pos = 0
+        end = len(buff)
+        while True:
+            if self._need is None:
+                if end - pos < self.header.size:
+                    break
+                self._need, = self.header.unpack_from(buff, pos)
+                if not self._need:
+                    raise FramingError("Empty message")
+                if self._need > self.max_length:
+                    raise FramingError("Message of %s bytes is longer than %s" % (self._need, self.max_length))
+                pos += self.header.size
+            if end - pos < self._need:
+                break
+            texts.append(buff[pos:pos + self._need])
+            pos += self._need
+            self._need = None
+        buff = buff[pos:]
+        self._parts = buff and [buff] or []
+        self._length = len(buff)
+        return texts
+
+    def frame(self, text):
+        return self.header.pack(len(text)) + text
+
+
+#### Test code ####
+
+class TestFraming(unittest.TestCase):
+    TEXTS = ['{"a":[1,"]}\\"{"]}', '[]', '"x"', 'true', '12', '{}', '4711']
+
+    def assertSplitEqual(self, framer_class, data, texts):
+        for size in (1, 2, 3, 7, len(data)):
+            framer = framer_class()
+            split_texts = []
+            for n in xrange(0, len(data), size):
+                split_texts.extend(framer.split(data[n:n + size]))
+            split_texts.extend(framer.close())
+            self.assertEqual(split_texts, texts)
+
+    def assertFramedEqual(self, framer_class):
+        framer = framer_class()
+        self.assertSplitEqual(framer_class, ''.join(framer.frame(text) for text in self.TEXTS), self.TEXTS)
+
+    def test_stream_framer(self):
+        self.assertFramedEqual(StreamFramer)
+        self.assertSplitEqual(StreamFramer, ' 1 truefalse[2]"a" ', ['1', 'true', 'false', '[2]', '"a"'])
+
+    def test_line_framer(self):
+        self.assertFramedEqual(LineFramer)
+        self.assertSplitEqual(LineFramer, '\n[1, 2]\r\n\n  \n3', ['[1, 2]\r', '3'])
+
+    def test_length_prefix_framer(self):
+        self.assertFramedEqual(LengthPrefixFramer)
+        self.assertEqual(LengthPrefixFramer().frame('[]'), '\0\0\0\x02[]')
+
+    def test_length_prefix_framer_limits(self):
+        framer = LengthPrefixFramer(max_length=4)
+        self.assertEqual(framer.split(framer.frame('4711')), ['4711'])
+        self.assertRaises(FramingError, lambda: framer.split('\0\0\0\x0512345'))
+        self.assertRaises(FramingError, lambda: LengthPrefixFramer().split('\xff\xff\xff\xff'))
+        self.assertRaises(FramingError, lambda: LengthPrefixFramer().split('\0\0\0\0'))
+
+if __name__ == "__main__":
+    unittest.main()
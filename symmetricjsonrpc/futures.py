@@ -0,0 +1,319 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""A minimal implementation of the Future interface of
+concurrent.futures, which is not available in all the Python versions
+supported, together with wait() and as_completed() for waiting on many
+futures at once."""
+
+from __future__ import with_statement
+
+import StringIO
+import sys
+import threading
+import time
+import traceback
+import unittest
+
+FIRST_COMPLETED = 'FIRST_COMPLETED'
+FIRST_EXCEPTION = 'FIRST_EXCEPTION'
+ALL_COMPLETED = 'ALL_COMPLETED'
+
+class Error(Exception):
+    pass
+
+class TimeoutError(Error):
+    pass
+
+class CancelledError(Error):
+    pass
+
+_PENDING, _CANCELLED, _FINISHED = range(3)
+
+class Future(object):
+    """The result of an operation that may not have completed yet.
+
+    The interface is that of concurrent.futures.Future. Whoever
+    creates a future completes it with set_result() or
+    set_exception()."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = _PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._waiters = []
+
+    def cancel(self):
+        with self._condition:
+            if self._state == _FINISHED:
+                return False
+            if self._state == _PENDING:
+                self._state = _CANCELLED
+                self._complete()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == _CANCELLED
+
+    def running(self):
+        return False
+
+    def done(self):
+        return self._state != _PENDING
+
+    def _get_result(self):
+        if self._state == _CANCELLED:
+            raise CancelledError()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def _wait(self, timeout):
+        with self._condition:
+            if self._state == _PENDING:
+                self._condition.wait(timeout)
+            if self._state == _PENDING:
+                raise TimeoutError()
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        return self._get_result()
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        if self._state == _CANCELLED:
+            raise CancelledError()
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._condition:
+            if self._state == _PENDING:
+                self._callbacks.append(fn)
+                return
+        self._call(fn)
+
+    def set_result(self, result):
+        with self._condition:
+            if self._state != _PENDING:
+                return
+            self._result = result
+            self._state = _FINISHED
+            self._complete()
+        self._run_callbacks()
+
+    def set_exception(self, exception):
+        with self._condition:
+            if self._state != _PENDING:
+                return
+            self._exception = exception
+            self._state = _FINISHED
+            self._complete()
+        self._run_callbacks()
+
+    def _complete(self):
+        self._condition.notifyAll()
+        for waiter in self._waiters:
+            waiter.add(self)
+
+    def _run_callbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._call(fn)
+
+    def _call(self, fn):
+        # Callbacks are run by whatever thread completes the future,
+        # such as the reading thread of a connection, which must not
+        # be stopped by them.
+        try:
+            fn(self)
+        except Exception:
+            traceback.print_exc()
+
+class _Waiter(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.finished = []
+
+    def add(self, future):
+        with self.condition:
+            self.finished.append(future)
+            self.condition.notifyAll()
+
+def _install_waiter(fs):
+    waiter = _Waiter()
+    pending = set()
+    for f in fs:
+        with f._condition:
+            if f.done():
+                waiter.finished.append(f)
+            else:
+                f._waiters.append(waiter)
+                pending.add(f)
+    return waiter, pending
+
+def _remove_waiter(fs, waiter):
+    for f in fs:
+        with f._condition:
+            if waiter in f._waiters:
+                f._waiters.remove(waiter)
+
+def wait(fs, timeout=None, return_when=ALL_COMPLETED):
+    """Waits for the futures in fs to complete. Returns a pair of
+    sets, the completed futures and the rest."""
+    fs = set(fs)
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    waiter, pending = _install_waiter(fs)
+    try:
+        with waiter.condition:
+            while True:
+                done = set(waiter.finished)
+                if not fs - done:
+                    break
+                if return_when == FIRST_COMPLETED and done:
+                    break
+                if return_when == FIRST_EXCEPTION and [f for f in done if not f.cancelled() and f._exception is not None]:
+                    break
+                if deadline is None:
+                    waiter.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    waiter.condition.wait(remaining)
+    finally:
+        _remove_waiter(pending, waiter)
+    return done, fs - done
+
+def as_completed(fs, timeout=None):
+    """Returns an iterator over the futures in fs, yielding them as
+    they complete. Raises TimeoutError if they have not all completed
+    within timeout seconds."""
+    fs = set(fs)
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    waiter, pending = _install_waiter(fs)
+    try:
+        yielded = 0
+        while yielded < len(fs):
+            with waiter.condition:
+                while len(waiter.finished) == yielded:
+                    if deadline is None:
+                        waiter.condition.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise TimeoutError()
+                        waiter.condition.wait(remaining)
+                finished = waiter.finished[yielded:]
+            for f in finished:
+                yielded += 1
+                yield f
+    finally:
+        _remove_waiter(pending, waiter)
+
+
+#### Test code ####
+
+class TestFutures(unittest.TestCase):
+    def complete_later(self, futures):
+        def complete():
+            for n, f in enumerate(futures):
+                time.sleep(0.01)
+                if n == 1:
+                    f.set_exception(ValueError(n))
+                else:
+                    f.set_result(n)
+        thread = threading.Thread(target=complete)
+        thread.start()
+        return thread
+
+    def test_result(self):
+        f = Future()
+        self.assertRaises(TimeoutError, lambda: f.result(0.01))
+        callbacks = []
+        f.add_done_callback(callbacks.append)
+        f.set_result(4711)
+        f.set_result(17)
+        self.assertTrue(f.done())
+        self.assertEqual(f.result(), 4711)
+        self.assertEqual(f.exception(), None)
+        self.assertEqual(callbacks, [f])
+
+    def test_callback_exception(self):
+        f = Future()
+        def fail(f):
+            raise ValueError("callback")
+        callbacks = []
+        f.add_done_callback(fail)
+        f.add_done_callback(callbacks.append)
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            f.set_result(4711)
+            f.add_done_callback(fail)
+        finally:
+            stderr, sys.stderr = sys.stderr, stderr
+        self.assertEqual(callbacks, [f])
+        self.assertEqual(stderr.getvalue().count("ValueError: callback"), 2)
+
+    def test_exception(self):
+        f = Future()
+        f.set_exception(ValueError("foo"))
+        self.assertRaises(ValueError, f.result)
+        self.assertEqual(type(f.exception()), ValueError)
+
+    def test_cancel(self):
+        f = Future()
+        self.assertTrue(f.cancel())
+        self.assertTrue(f.cancelled())
+        self.assertRaises(CancelledError, f.result)
+        f = Future()
+        f.set_result(1)
+        self.assertFalse(f.cancel())
+
+    def test_wait(self):
+        fs = [Future() for n in xrange(3)]
+        thread = self.complete_later(fs)
+        done, not_done = wait(fs, return_when=FIRST_COMPLETED)
+        self.assertTrue(fs[0] in done)
+        done, not_done = wait(fs, return_when=FIRST_EXCEPTION)
+        self.assertTrue(fs[1] in done)
+        done, not_done = wait(fs)
+        self.assertEqual((done, not_done), (set(fs), set()))
+        thread.join()
+        self.assertEqual(wait([Future()], timeout=0.01)[0], set())
+
+    def test_as_completed(self):
+        fs = [Future() for n in xrange(3)]
+        thread = self.complete_later(fs)
+        self.assertEqual(list(as_completed(fs)), fs)
+        thread.join()
+        self.assertRaises(TimeoutError, lambda: list(as_completed([Future()], timeout=0.01)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,10 +23,13 @@
 
 """JSON (de)serialization facilities."""
 
+import inspect
+import re
 import sys
-import StringIO
+import types
 import unittest
 
+import framing
 import wrappers
 
 def from_json(str):
@@ -36,10 +39,25 @@ def from_json(str):
 
 def to_json(obj):
     """Return a json string representing the python object obj."""
-    i = StringIO.StringIO()
-    w = Writer(i, encoding='UTF-8')
-    w.write_value(obj)
-    return i.getvalue()
+    return Writer(None, encoding='UTF-8').encode(obj)
+
+_escape_re = re.compile(r'[^ !#-\[\]-~]')
+_escapes = {u'\b': r'\b',
+            u'\t': r'\t',
+            u'\n': r'\n',
+            u'\f': r'\f',
+            u'\r': r'\r',
+            u'"': r'\"',
+            u'\\': r'\\'}
+
+def _escape_char(match):
+    c = match.group()
+    if c in _escapes:
+        return _escapes[c]
+    elif c > u'~':
+        return r'\u%04x' % ord(c)
+    else:
+        raise Exception("Cannot encode character %x into json string" % ord(c))
 
 class Writer(object):
     """A serializer for python values to JSON. Allowed types for
@@ -55,14 +73,39 @@ class Writer(object):
         * List
         * Dict (keys must be String or Unicode)
         * any object with a __to_json__ method
+        * any object of a type added with Writer.register()
 
     The writer must be instantiated with a file-like object to write
     the serialized json to as sole argument. To actually serialize
-    data, call the write_value() or write_values() methods."""
+    data, call the write_value() or write_values() methods.
+
+    Values are encoded into a list of string fragments that is handed
+    to the underlying file-like object in one go. The encoding
+    function to use is looked up on the type of each value in a table
+    that is filled in as new types are encountered."""
+
+    converters = {}
 
     def __init__(self, s, encoding=None):
         self.encoding = encoding
         self.s = wrappers.WriterWrapper(s)
+        cls = type(self)
+        if '_encoders' not in cls.__dict__:
+            cls._encoders = {}
+
+    @classmethod
+    def register(cls, type, converter):
+        """Serialize values of type (or a subclass of it) as
+        converter(value), which works just like a __to_json__
+        method. Registering on a subclass of Writer only affects that
+        subclass."""
+        cls.converters = dict(cls.converters)
+        cls.converters[type] = converter
+        def reset(c):
+            c._encoders = {}
+            for subclass in c.__subclasses__():
+                reset(subclass)
+        reset(cls)
 
     def close(self):
         self.s.close()
@@ -72,66 +115,121 @@ class Writer(object):
         self.s.flush()
 
     def unflushed_write_value(self, value):
+        out = []
+        self._encode(value, out)
+        self.s.writelines(out)
+
+    def unflushed_write_values(self, values):
+        for value in values:
+            self.unflushed_write_value(value)
+
+    def encode(self, value):
+        """Return the JSON string representing value."""
+        out = []
+        self._encode(value, out)
+        return ''.join(out)
+
+    def write_encoded(self, texts):
+        """Write and flush a list of values already encoded with
+        encode()."""
+        self.s.writelines(texts)
+        self.s.flush()
+
+    def _encode(self, value, out):
+        t = type(value)
+        encoder = self._encoders.get(t)
+        if encoder is None:
+            encoder = self._encoders[t] = self._find_encoder(t)
+        encoder(self, value, out)
+
+    def _find_encoder(self, t):
+        if t is types.InstanceType:
+            # All old-style instances share one type
+            return Writer._encode_any
+        for base in inspect.getmro(t):
+            if base in self.converters:
+                converter = self.converters[base]
+                return lambda self, value, out: self._encode(converter(value), out)
+        if hasattr(t, '__to_json__'):
+            return Writer._encode_to_json
+        elif issubclass(t, unicode):
+            return Writer._encode_unicode
+        elif issubclass(t, str):
+            return Writer._encode_str
+        elif issubclass(t, bool):
+            return Writer._encode_bool
+        elif issubclass(t, (int, long, float)):
+            return Writer._encode_number
+        elif t is types.NoneType:
+            return Writer._encode_null
+        elif hasattr(t, '__iter__'):
+            if hasattr(t, 'iteritems'):
+                return Writer._encode_dict
+            return Writer._encode_list
+        return Writer._encode_any
+
+    def _encode_any(self, value, out):
         if hasattr(value, '__to_json__'):
-            self.unflushed_write_value(value.__to_json__())
-        elif isinstance(value, unicode):
-            self.s.write('"')
-            for c in value:
-                if c == '\b':
-                    self.s.write(r'\b')
-                elif c == '\t':
-                    self.s.write(r'\t')
-                elif c == '\n':
-                    self.s.write(r'\n')
-                elif c == '\f':
-                    self.s.write(r'\f')
-                elif c == '\r':
-                    self.s.write(r'\r')
-                elif c == '"':
-                    self.s.write(r'\"')
-                elif c == '\\':
-                    self.s.write(r'\\')
-                elif c >= ' ' and c <= '~':
-                    self.s.write(c.encode('ascii'))
-                elif c > '~':
-                    self.s.write(r'\u%04x' % ord(c))
-                else:
-                    raise Exception("Cannot encode character %x into json string" % ord(c))
-            self.s.write('"')
-        elif isinstance(value, str):
-            self.unflushed_write_value(value.decode(self.encoding or sys.getdefaultencoding()))
-        elif isinstance(value, bool):
-            self.s.write(value and 'true' or 'false')
-        elif isinstance(value, int) or isinstance(value, float) or isinstance(value, long):
-            r = repr(value)
-            if r[-1] == 'L':
-                r = r[:-1]
-            self.s.write(r)
+            self._encode_to_json(value, out)
         elif value == None:
-            self.s.write('null')
+            self._encode_null(value, out)
         elif hasattr(value, '__iter__'):
-            if hasattr(value,'iteritems'):
-                self.s.write('{')
-                for n, (k, v) in enumerate(value.iteritems()):
-                    if (n > 0):
-                        self.s.write(',')
-                    self.unflushed_write_value(k)
-                    self.s.write(':')
-                    self.unflushed_write_value(v)
-                self.s.write('}')
+            if hasattr(value, 'iteritems'):
+                self._encode_dict(value, out)
             else:
-                self.s.write('[')
-                for n, i in enumerate(value):
-                    if (n > 0):
-                        self.s.write(',')
-                    self.unflushed_write_value(i)
-                self.s.write(']')
+                self._encode_list(value, out)
         else:
             raise Exception("Cannot encode %s of type %s to json" % (value,type(value)))
 
-    def unflushed_write_values(self, values):
-        for value in values:
-            self.unflushed_write_value(value)
+    def _encode_to_json(self, value, out):
+        self._encode(value.__to_json__(), out)
+
+    def _encode_unicode(self, value, out):
+        out.append('"%s"' % (_escape_re.sub(_escape_char, value).encode('ascii'),))
+
+    def _encode_str(self, value, out):
+        self._encode_unicode(value.decode(self.encoding or sys.getdefaultencoding()), out)
+
+    def _encode_bool(self, value, out):
+        out.append(value and 'true' or 'false')
+
+    def _encode_number(self, value, out):
+        r = repr(value)
+        if r[-1] == 'L':
+            r = r[:-1]
+        out.append(r)
+
+    def _encode_null(self, value, out):
+        out.append('null')
+
+    def _encode_dict(self, value, out):
+        out.append('{')
+        first = True
+        for k, v in value.iteritems():
+            if first:
+                first = False
+            else:
+                out.append(',')
+            self._encode(k, out)
+            out.append(':')
+            self._encode(v, out)
+        out.append('}')
+
+    def _encode_list(self, value, out):
+        out.append('[')
+        first = True
+        for v in value:
+            if first:
+                first = False
+            else:
+                out.append(',')
+            self._encode(v, out)
+        out.append(']')
+
+def _defining_class(cls, name):
+    for c in cls.__mro__:
+        if name in c.__dict__:
+            return c
 
 class Tokenizer(object):
     """A SAX-like recursive-descent parser for JSON.
@@ -140,11 +238,19 @@ class Tokenizer(object):
     only provides tokenization (just like a SAX parser for XML).
 
     This class must be subclassed to be useful. See Reader for
-    a full example."""
+    a full example.
+
+    Runs of plain characters in strings and numbers are reported
+    through a single call to chars(). Subclasses that override char()
+    but not chars() (for example DebugTokenizer) still get one call to
+    char() per character."""
 
     def __init__(self, s):
         self.closable = wrappers.ReaderWrapper(s)
-        self.s = wrappers.ReIterator(self.closable)
+        self.s = wrappers.Cursor(self.closable)
+        mro = type(self).__mro__
+        if mro.index(_defining_class(type(self), 'char')) < mro.index(_defining_class(type(self), 'chars')):
+            self.chars = Tokenizer.chars.__get__(self)
 
     # Override these in a subclass to actually do something with the
     # parsed data
@@ -159,6 +265,9 @@ class Tokenizer(object):
     def number_begin(self): pass
     def number_end(self): pass
     def char(self, c): pass
+    def chars(self, run):
+        for c in run:
+            self.char(c)
     def true(self): pass
     def false(self): pass
     def null(self): pass
@@ -170,8 +279,7 @@ class Tokenizer(object):
         return c
 
     def _read_space(self):
-        while self.s.peek() in ' \t\r\n':
-            self.s.next()
+        return self.s.skip_whitespace()
 
     def _read_pair(self):
         self.pair_begin()
@@ -233,7 +341,12 @@ class Tokenizer(object):
     def _read_string(self):
         self.string_begin()
         self._assert(self.s.next(), '"')
-        while self.s.peek() != '"':
+        while True:
+            run = self.s.take_until('"\\')
+            if run:
+                self.chars(run)
+            if self.s.peek() == '"':
+                break
             self._read_char()
         self._assert(self.s.next(), '"')
         self.string_end()
@@ -252,21 +365,17 @@ class Tokenizer(object):
                 self.char(self.s.next())
             else:
                 self._assert(self.s.peek(), '123456789')
-                self.char(self.s.next())
-                while self.s.peek() in '0123456789':
-                    self.char(self.s.next())
+                self.chars(self.s.take_while('0123456789'))
             if self.s.peek() == '.':
                 self.char(self.s.next())
                 self._assert(self.s.peek(), '0123456789')
-                while self.s.peek() in '0123456789':
-                    self.char(self.s.next())
+                self.chars(self.s.take_while('0123456789'))
             if self.s.peek() in 'eE':
                 self.char(self.s.next())
                 if self.s.peek() in '+-':
                     self.char(self.s.next())
                 self._assert(self.s.peek(), '0123456789')
-                while self.s.peek() in '0123456789':
-                    self.char(self.s.next())
+                self.chars(self.s.take_while('0123456789'))
         except EOFError:
             pass
         self.number_end()
@@ -294,8 +403,7 @@ class Tokenizer(object):
         self.null()
 
     def _read_value(self):
-        self._read_space()
-        c = self.s.peek()
+        c = self._read_space()
         if c == '{': return self._read_object()
         elif c == '[': return self._read_array()
         elif c == '"': return self._read_string()
@@ -348,16 +456,22 @@ class Reader(Tokenizer):
             self.state[-1] = cls(params, self.state[-1])
     def array_begin(self): self._struct_begin()
     def array_end(self): self._struct_end()
-    def string_begin(self): self.state.append(u"")
-    def string_end(self):  self._struct_end()
-    def number_begin(self): self.state.append(u"")
+    # Strings and numbers are collected as a list of fragments and
+    # only joined at the end, to keep decoding linear in their length.
+    def string_begin(self): self.state.append([])
+    def string_end(self):
+        self.state[-1] = u"".join(self.state[-1])
+        self._struct_end()
+    def number_begin(self): self.state.append([])
     def number_end(self):
-        if '.' in self.state[-1] or 'e' in self.state[-1] or 'E' in self.state[-1]:
-            self.state[-1] = float(self.state[-1])
+        number = "".join(self.state[-1])
+        if '.' in number or 'e' in number or 'E' in number:
+            self.state[-1] = float(number)
         else:
-            self.state[-1] = int(self.state[-1])
+            self.state[-1] = int(number)
         self._struct_end()
-    def char(self, c): self.state[-1] = self.state[-1] + c
+    def char(self, c): self.state[-1].append(c)
+    def chars(self, run): self.state[-1].append(run)
     def true(self): self.state[-1].append(True)
     def false(self): self.state[-1].append(False)
     def null(self): self.state[-1].append(None)
@@ -375,6 +489,39 @@ class Reader(Tokenizer):
         except EOFError:
             return
 
+class IncrementalReader(object):
+    """A push parser counterpart of Reader.
+
+    Instead of reading from a file-like object, data is handed to the
+    parser with feed() whenever it becomes available, and feed()
+    returns a list of all the values completed by that data. Partial
+    values are kept between calls, so a single thread can decode data
+    from many connections, e.g. from a poll loop.
+
+    The end of each top level value is found by a
+    framing.StreamFramer. The complete value is then parsed with
+    decode(), which uses a Reader, so the results are the same as
+    those of Reader.read_values()."""
+
+    def __init__(self, object_initializer = None):
+        self.object_initializer = object_initializer
+        self.framer = framing.StreamFramer()
+
+    def decode(self, text):
+        """Parses the text of a single complete value."""
+        return Reader(text, self.object_initializer).read_value()
+
+    def feed(self, data):
+        """Returns a list of all values completed by data."""
+        return [self.decode(text) for text in self.framer.split(data)]
+
+    def close(self):
+        """Signals the end of the input. Returns a list holding the
+        last value if it was a number, as those have no terminating
+        character. Any other incomplete value is discarded, just as
+        Reader.read_values() does at EOF."""
+        return [self.decode(text) for text in self.framer.close()]
+
 class DebugTokenizer(object):
     def pair_begin(self): print '('; print self.state; return super(DebugTokenizer, self).pair_begin()
     def pair_end(self): print ')'; print self.state; return super(DebugTokenizer, self).pair_end()
@@ -461,6 +608,12 @@ class TestJson(unittest.TestCase):
 
         for i, r in enumerate(reader.read_values()):
             self.assertEqual(r, values[i])
+    def test_write_escape_string(self):
+        self.assertWriteEqual(r'"a\b\f\n\r\t\"\\/ ~\u007f\u00e9\u1234z"',
+                              u'a\b\f\n\r\t"\\/ ~\x7f\xe9\u1234z')
+        self.assertWriteEqual(r'"\u00e5"', u'\xe5'.encode('UTF-8'))
+        self.assertRaises(Exception, lambda: to_json(u'abc\x00'))
+        self.assertRaises(Exception, lambda: to_json(u'\x1f'))
     def test_encode_invalid_control_character(self):
         self.assertRaises(Exception, lambda: json('\x00', self.tempfile.TemporaryFile()))
     def test_encode_invalid_object(self):
@@ -526,6 +679,95 @@ class TestJson(unittest.TestCase):
         if timeout.isAlive():
             self.fail('Reader has hung.')
 
+    def test_buffered_read(self):
+        obj = {'foo':1, 'bar':[1, 2], 'baz':u"x" * 1000}
+        io = self.tempfile.TemporaryFile()
+        Writer(io).write_value(obj)
+        io.seek(0)
+        full_json_string = io.read()
+
+        for read_size in (1, 3, 64, 65536):
+            sockets = self.socket.socketpair()
+            sockets[1].sendall(full_json_string)
+            sockets[1].close()
+            reader = wrappers.SocketReader(sockets[0], read_size=read_size)
+            self.assertEqual(''.join(reader), full_json_string)
+
+            io.seek(0)
+            reader = wrappers.FileReader(io, read_size=read_size)
+            self.assertEqual(from_json(reader), obj)
+
+        # Data already buffered by the file object is read too.
+        io = self.tempfile.TemporaryFile()
+        io.write('header\n' + full_json_string)
+        io.seek(0)
+        self.assertEqual(io.readline(), 'header\n')
+        self.assertEqual(from_json(wrappers.FileReader(io)), obj)
+
+    def test_partial_write(self):
+        sockets = self.socket.socketpair()
+        sockets[0].setsockopt(self.socket.SOL_SOCKET, self.socket.SO_SNDBUF, 4096)
+        obj = [u"x" * 100000, u"y" * 3000000, u"z"]
+        class Writing(self.threading.Thread):
+            def run(self1):
+                Writer(sockets[0]).write_value(obj)
+                sockets[0].close()
+        writing = Writing()
+        writing.start()
+        self.assertEqual(Reader(sockets[1]).read_value(), obj)
+        writing.join()
+
+    def test_read_chunks(self):
+        STR = '{"foo" :[12, 3.45e6, "a\\"bc"],  "bar":  "baz"}  17'
+        OBJ = {u"foo": [12, 3.45e6, u'a"bc'], u"bar": u"baz"}
+        for size in (1, 2, 3, 5, 7):
+            chunks = [STR[n:n + size] for n in xrange(0, len(STR), size)]
+            self.assertEqual(list(Reader(iter(chunks)).read_values()), [OBJ, 17])
+
+    def test_chars_fallback(self):
+        class CharReader(Reader):
+            def char(self, c):
+                self.calls.append(c)
+                Reader.char(self, c)
+        class RunReader(Reader):
+            def chars(self, run):
+                self.calls.append(run)
+                Reader.chars(self, run)
+        STR = '["abc\\ndef", 1234]'
+        OBJ = [u"abc\ndef", 1234]
+        for cls, calls in ((CharReader, list("abc\ndef1234")),
+                           (RunReader, ["abc", "def", "1234"])):
+            reader = cls(STR)
+            reader.calls = []
+            self.assertEqual(reader.read_value(), OBJ)
+            self.assertEqual(reader.calls, calls)
+
+    def test_read_long_string(self):
+        # How the time taken scales with the length is measured by
+        # benchmarks/bench_codec.py.
+        chunk = 'x' * 62 + '\\n'
+        STR = '"%s"' % (chunk * 2000,)
+        self.assertEqual(Reader(STR).read_value(), ('x' * 62 + '\n') * 2000)
+
+    def test_incremental_reader(self):
+        STR = '{"a": [1, {"b": "}]\\"["}], "c": "\\\\"} [] "x{" true false null 12 -3.5e+2 [ "y" ] 4711'
+        values = list(Reader(STR).read_values())
+        self.assertEqual(len(values), 10)
+        for size in (1, 2, 3, 7, len(STR)):
+            reader = IncrementalReader()
+            read_values = []
+            for n in xrange(0, len(STR), size):
+                read_values.extend(reader.feed(STR[n:n + size]))
+            self.assertEqual(read_values, values[:-1])
+            self.assertEqual(reader.close(), values[-1:])
+
+    def test_incremental_reader_object(self):
+        STR = '{"__jsonclass__":["foo","bar"],"naja":123}'
+        reader = IncrementalReader({'foo': lambda arg, kw: (arg, kw)})
+        self.assertEqual(reader.feed(STR[:5]), [])
+        self.assertEqual(reader.feed(STR[5:]), [(["bar"], {"naja": 123})])
+        self.assertRaises(Exception, lambda: reader.feed('}'))
+
     def test_write_object(self):
         class SomeObj(object):
             def __init__(self, x):
@@ -536,5 +778,23 @@ class TestJson(unittest.TestCase):
 
         self.assertWriteEqual('{"x":4711,"__jsonclass__":["SomeObj"]}', SomeObj(4711))
 
+    def test_write_types(self):
+        class OldStyle:
+            def __to_json__(self):
+                return [1]
+        class SomeDict(dict): pass
+        class SomeInt(int): pass
+        self.assertWriteEqual('[[1],{"a":1.5},2,12345678901234567890,null,[1,2],"\\u00e5"]',
+                              [OldStyle(), SomeDict(a=1.5), SomeInt(2), 12345678901234567890L,
+                               None, (1, 2), u'\xe5'])
+        self.assertRaises(Exception, lambda: to_json(object()))
+
+    def test_write_registered_type(self):
+        import decimal
+        class DecimalWriter(Writer): pass
+        DecimalWriter.register(decimal.Decimal, str)
+        self.assertEqual(DecimalWriter(None).encode([decimal.Decimal("1.5")]), '["1.5"]')
+        self.assertRaises(Exception, lambda: to_json(decimal.Decimal("1.5")))
+
 if __name__ == "__main__":
     unittest.main()
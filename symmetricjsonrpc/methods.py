@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Registries of the methods a connection serves, as an alternative
+to overriding dispatch_request() and dispatch_notification().
+
+A MethodRegistry is given to an RPCClient, RPCServer or RPCProtocol
+as the methods keyword argument or class attribute, and the methods
+called by the remote side are then looked up in it by name:
+
+    methods = MethodRegistry()
+
+    @methods.register
+    def add(a, b):
+        return a + b
+
+    @methods.register("echo", inline=True)
+    def echo(value):
+        return value
+
+    server = RPCServer(sock, methods=methods)
+"""
+
+import inspect
+import types
+import unittest
+
+class MethodNotFound(Exception):
+    """Raised for a call to a method that is not registered."""
+
+class InvalidParams(TypeError):
+    """Raised for a call with parameters that do not match the
+    signature of the method."""
+
+class Method(object):
+    """A registered method.
+
+    The signature of func is inspected once, when the method is
+    created, and the parameters of each call are checked against
+    it. A list of parameters is passed positionally, and an object by
+    name. If pass_connection is set, the connection the call came in
+    on is passed as the first argument.
+
+    Inline methods are run by the thread reading the connection
+    instead of being dispatched, which saves a thread handover for
+    methods that return quickly, but holds up everything else coming
+    in on the connection until they do. In particular, they must not
+    wait for responses to requests of their own on the connection."""
+
+    def __init__(self, name, func, inline=False, pass_connection=False):
+        self.name = name
+        self.func = func
+        self.inline = inline
+        self.pass_connection = pass_connection
+        self._inspect()
+
+    def _inspect(self):
+        func = self.func
+        skip = 0
+        if isinstance(func, (type, types.ClassType)):
+            func = getattr(func, '__init__', None)
+            skip = 1
+        elif not isinstance(func, (types.FunctionType, types.MethodType)):
+            func = getattr(func, '__call__', None)
+            skip = 1
+        if isinstance(func, types.MethodType):
+            func = func.im_func
+            skip = 1
+        if self.pass_connection:
+            skip += 1
+        try:
+            args, varargs, varkw, defaults = inspect.getargspec(func)
+        except TypeError:
+            # A builtin, or something else that can not be inspected;
+            # let it check its parameters itself.
+            self.names = None
+            return
+        self.names = args[skip:]
+        self.max_args = varargs is None and len(self.names) or None
+        self.required = self.names[:len(self.names) - len(defaults or ())]
+        self.any_names = varkw is not None
+
+    def check(self, params):
+        """Raises InvalidParams unless the parameters params, a list
+        or a dictionary, can be passed to the method."""
+        if self.names is None:
+            return
+        if isinstance(params, dict):
+            for name in self.required:
+                if name not in params:
+                    raise InvalidParams("%s() missing parameter %s" % (self.name, name))
+            if not self.any_names:
+                for name in params:
+                    if name not in self.names:
+                        raise InvalidParams("%s() got an unexpected parameter %s" % (self.name, name))
+        elif isinstance(params, (list, tuple)):
+            if len(params) < len(self.required) or (self.max_args is not None and len(params) > self.max_args):
+                if self.max_args is None:
+                    expected = "at least %s" % len(self.required)
+                elif self.max_args == len(self.required):
+                    expected = "%s" % self.max_args
+                else:
+                    expected = "%s to %s" % (len(self.required), self.max_args)
+                raise InvalidParams("%s() takes %s parameters (%s given)" % (self.name, expected, len(params)))
+        else:
+            raise InvalidParams("%s() params must be an array or an object" % (self.name,))
+
+    def call(self, connection, params):
+        """Calls the method with params, a list or a dictionary, as
+        received on connection."""
+        if params is None:
+            params = []
+        self.check(params)
+        args = ()
+        if self.pass_connection:
+            args = (connection,)
+        if isinstance(params, dict):
+            kw = {}
+            for name, value in params.iteritems():
+                try:
+                    kw[str(name)] = value
+                except UnicodeEncodeError:
+                    raise InvalidParams("%s() got an invalid parameter name %r" % (self.name, name))
+            return self.func(*args, **kw)
+        return self.func(*(args + tuple(params)))
+
+class MethodRegistry(object):
+    """A table of methods by name. See the module documentation."""
+
+    def __init__(self):
+        self.methods = {}
+
+    def register(self, name=None, func=None, inline=False, pass_connection=False):
+        """Registers func as the method name, and returns func.
+
+        Can also be used as a decorator, either directly or called
+        with the method name and options; the method name defaults to
+        the name of the function."""
+        if callable(name) and func is None:
+            name, func = None, name
+        if func is None:
+            def decorator(func):
+                return self.register(name, func, inline, pass_connection)
+            return decorator
+        if name is None:
+            name = func.__name__
+        self.methods[name] = Method(name, func, inline, pass_connection)
+        return func
+
+    def unregister(self, name):
+        del self.methods[name]
+
+    def get(self, name):
+        """Returns the Method registered as name, or None."""
+        return self.methods.get(name)
+
+    def is_inline(self, name):
+        method = self.methods.get(name)
+        return method is not None and method.inline
+
+    def call(self, connection, subject):
+        """Calls the method requested by the message subject,
+        received on connection, and returns its result."""
+        method = self.methods.get(subject['method'])
+        if method is None:
+            raise MethodNotFound(subject['method'])
+        return method.call(connection, subject.get('params'))
+
+    def __contains__(self, name):
+        return name in self.methods
+
+    def __iter__(self):
+        return iter(self.methods)
+
+
+#### Test code ####
+
+class TestMethods(unittest.TestCase):
+    def setUp(self):
+        self.methods = MethodRegistry()
+
+    def call(self, method, params):
+        return self.methods.call(None, {'method': method, 'params': params})
+
+    def test_register(self):
+        @self.methods.register
+        def add(a, b=1):
+            return a + b
+        self.methods.register("sub", lambda a, b: a - b)
+        @self.methods.register("connection", pass_connection=True, inline=True)
+        def connection(connection):
+            return connection
+
+        self.assertEqual(self.call("add", [1, 2]), 3)
+        self.assertEqual(self.call("add", [1]), 2)
+        self.assertEqual(self.call("add", {'a': 1, 'b': 3}), 4)
+        self.assertEqual(self.call("sub", [3, 2]), 1)
+        self.assertEqual(self.methods.call("conn", {'method': "connection"}), "conn")
+        self.assertTrue(self.methods.is_inline("connection"))
+        self.assertFalse(self.methods.is_inline("add"))
+        self.assertEqual(sorted(self.methods), ["add", "connection", "sub"])
+        self.assertRaises(MethodNotFound, lambda: self.call("mul", []))
+
+    def test_check(self):
+        class Adder(object):
+            def add(self, a, *rest):
+                return a + sum(rest)
+            def __call__(self, a, **kw):
+                return a
+        adder = Adder()
+        self.methods.register("add", adder.add)
+        self.methods.register("call", adder)
+        self.methods.register("max", max)
+        self.methods.register("sub", lambda a, b: a - b)
+
+        self.assertEqual(self.call("add", [1, 2, 3]), 6)
+        self.assertRaises(InvalidParams, lambda: self.call("add", []))
+        self.assertEqual(self.call("call", {'a': 1, 'b': 2}), 1)
+        self.assertRaises(InvalidParams, lambda: self.call("call", {'b': 2}))
+        self.assertRaises(InvalidParams, lambda: self.call("call", {'a': 1, u'\xe5': 2}))
+        self.assertEqual(self.call("max", [1, 3, 2]), 3)
+        self.assertRaises(InvalidParams, lambda: self.call("sub", [1]))
+        self.assertRaises(InvalidParams, lambda: self.call("sub", [1, 2, 3]))
+        self.assertRaises(InvalidParams, lambda: self.call("sub", {'a': 1, 'c': 2}))
+        self.assertRaises(InvalidParams, lambda: self.call("sub", 1))
+
+if __name__ == "__main__":
+    unittest.main()
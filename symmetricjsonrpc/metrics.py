@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Counters and latency histograms for connections and the methods
+called over them.
+
+A Metrics registry is given to an RPCClient or RPCServer as the
+metrics keyword argument or class attribute. The connections then
+record, per method, the number of calls, errors and calls in flight
+and histograms of their latencies, both for calls made (client_*)
+and for calls handled (server_*), and per connection name the
+number of connections opened, closed and open, and of messages and
+bytes read and written (connection_*). Calls made that time out, and
+responses arriving after that, are counted as client_timeouts and
+client_late_responses.
+
+Each thread records into counters of its own, without locking, and
+the counters of all threads are only added up when they are read.
+If the metrics_method of the connection is set, such as to
+"rpc.metrics", the remote side can read them by calling that method
+(for a snapshot()) or rpc.metrics.text (for text())."""
+
+from __future__ import with_statement
+
+import bisect
+import threading
+import unittest
+
+class _Shard(object):
+    """The counters and histograms recorded by one thread."""
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}
+        self.histograms = {}
+
+    def merge(self, other):
+        for key, value in other.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, value in other.histograms.items():
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                self.histograms[key] = list(value)
+            else:
+                for n in xrange(len(value)):
+                    histogram[n] += value[n]
+
+class Metrics(object):
+    """A registry of counters and histograms, each identified by a
+    name and a label (a method name or a connection). See the module
+    documentation.
+
+    Histograms count observed values in buckets, whose upper bounds
+    are given by buckets."""
+
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    # Gauges computed from the difference between two counters
+    gauges = {'client_in_flight': ('client_calls', 'client_completed'),
+              'server_in_flight': ('server_calls', 'server_completed'),
+              'connection_open': ('connection_opened', 'connection_closed')}
+
+    # The name of the label for the metrics starting with a word, for
+    # text(). Others are labelled by method.
+    label_names = {'connection': 'connection'}
+
+    prefix = "symmetricjsonrpc_"
+
+    # Shards of threads that have exited are merged after this many
+    # new shards have been created, and on reads.
+    retire_interval = 64
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = _Shard(None)
+        self._created = 0
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(threading.currentThread())
+            with self._lock:
+                self._shards.append(shard)
+                self._created += 1
+                if self._created % self.retire_interval == 0:
+                    self._retire()
+            return shard
+
+    def _retire(self):
+        """Merges the shards of threads that have exited. Must be
+        called with the lock held."""
+        alive = []
+        for shard in self._shards:
+            if shard.thread.isAlive():
+                alive.append(shard)
+            else:
+                self._retired.merge(shard)
+        self._shards = alive
+
+    def count(self, name, label='', n=1):
+        """Adds n to a counter."""
+        counters = self._shard().counters
+        key = (name, label)
+        counters[key] = counters.get(key, 0) + n
+
+    def observe(self, name, label, value):
+        """Records value in a histogram."""
+        histograms = self._shard().histograms
+        key = (name, label)
+        histogram = histograms.get(key)
+        if histogram is None:
+            # The sum, the count, and the count per bucket, with an
+            # extra one for larger values.
+            histogram = histograms[key] = [0] * (len(self.buckets) + 3)
+        histogram[0] += value
+        histogram[1] += 1
+        histogram[2 + bisect.bisect_left(self.buckets, value)] += 1
+
+    def _merged(self):
+        with self._lock:
+            self._retire()
+            merged = _Shard(None)
+            merged.merge(self._retired)
+            for shard in self._shards:
+                merged.merge(shard)
+        return merged
+
+    def snapshot(self):
+        """Returns the current values, as a dictionary of
+        dictionaries, by name and then by label:
+
+            {'counters': {name: {label: value}},
+             'gauges': {name: {label: value}},
+             'histograms': {name: {label: {'sum': ..., 'count': ...,
+                                           'buckets': [[le, count], ...]}}}}
+
+        The bucket counts are cumulative, and the last le is None."""
+        merged = self._merged()
+        counters = {}
+        for (name, label), value in merged.counters.iteritems():
+            counters.setdefault(name, {})[label] = value
+        gauges = {}
+        for name, (started, finished) in self.gauges.iteritems():
+            for label, value in counters.get(started, {}).iteritems():
+                gauges.setdefault(name, {})[label] = value - counters.get(finished, {}).get(label, 0)
+        histograms = {}
+        for (name, label), value in merged.histograms.iteritems():
+            buckets = []
+            total = 0
+            for le, n in zip(self.buckets + (None,), value[2:]):
+                total += n
+                buckets.append([le, total])
+            histograms.setdefault(name, {})[label] = {'sum': value[0], 'count': value[1], 'buckets': buckets}
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def _labels(self, name, label, **extra):
+        labels = [(self.label_names.get(name.split('_')[0], 'method'), label)] + sorted(extra.items())
+        return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for key, value in labels)
+
+    def text(self):
+        """Returns the current values in the Prometheus text
+        exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, values in sorted(snapshot['counters'].iteritems()):
+            lines.append("# TYPE %s%s_total counter" % (self.prefix, name))
+            for label, value in sorted(values.iteritems()):
+                lines.append("%s%s_total%s %s" % (self.prefix, name, self._labels(name, label), value))
+        for name, values in sorted(snapshot['gauges'].iteritems()):
+            lines.append("# TYPE %s%s gauge" % (self.prefix, name))
+            for label, value in sorted(values.iteritems()):
+                lines.append("%s%s%s %s" % (self.prefix, name, self._labels(name, label), value))
+        for name, values in sorted(snapshot['histograms'].iteritems()):
+            lines.append("# TYPE %s%s histogram" % (self.prefix, name))
+            for label, value in sorted(values.iteritems()):
+                for le, n in value['buckets']:
+                    if le is None:
+                        le = "+Inf"
+                    lines.append("%s%s_bucket%s %s" % (self.prefix, name, self._labels(name, label, le=le), n))
+                lines.append("%s%s_sum%s %r" % (self.prefix, name, self._labels(name, label), value['sum']))
+                lines.append("%s%s_count%s %s" % (self.prefix, name, self._labels(name, label), value['count']))
+        return ''.join(line + '\n' for line in lines)
+
+
+#### Test code ####
+
+class TestMetrics(unittest.TestCase):
+    def test_merge(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.retire_interval = 2
+        def record():
+            metrics.count('server_calls', 'ping')
+            metrics.observe('server_latency', 'ping', 0.5)
+        threads = [threading.Thread(target=record) for n in xrange(5)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        metrics.count('server_calls', 'ping')
+        metrics.count('server_completed', 'ping', 4)
+        metrics.observe('server_latency', 'ping', 2.0)
+        self.assertTrue(len(metrics._shards) < 5)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(metrics._shards, [metrics._local.shard])
+        self.assertEqual(snapshot['counters'], {'server_calls': {'ping': 6}, 'server_completed': {'ping': 4}})
+        self.assertEqual(snapshot['gauges'], {'server_in_flight': {'ping': 2}})
+        self.assertEqual(snapshot['histograms'],
+                         {'server_latency': {'ping': {'sum': 4.5, 'count': 6,
+                                                      'buckets': [[0.1, 0], [1.0, 5], [None, 6]]}}})
+
+    def test_text(self):
+        metrics = Metrics(buckets=(1.0,))
+        metrics.count('connection_messages_in', 'a"b')
+        metrics.observe('client_latency', 'ping', 0.5)
+        self.assertEqual(metrics.text(),
+                         '# TYPE symmetricjsonrpc_connection_messages_in_total counter\n'
+                         'symmetricjsonrpc_connection_messages_in_total{connection="a\\"b"} 1\n'
+                         '# TYPE symmetricjsonrpc_client_latency histogram\n'
+                         'symmetricjsonrpc_client_latency_bucket{method="ping",le="1.0"} 1\n'
+                         'symmetricjsonrpc_client_latency_bucket{method="ping",le="+Inf"} 1\n'
+                         'symmetricjsonrpc_client_latency_sum{method="ping"} 0.5\n'
+                         'symmetricjsonrpc_client_latency_count{method="ping"} 1\n')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,297 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""A pool of outbound connections to one or more peers."""
+
+from __future__ import with_statement
+
+import itertools
+import socket
+import threading
+import time
+import unittest
+
+import methods
+import rpc
+
+class RPCClientPool(object):
+    """Keeps size connections, instances of client_class, to each of
+    one or more addresses, and sends each request over the connection
+    with the fewest requests waiting for their responses. Calls to a
+    busy peer are thus not all held up behind one socket and one
+    reading thread.
+
+    Unless warm is false, the connections are all opened when the pool
+    is created rather than on first use; warm_up() opens any that are
+    missing. Connections that die, or fail while sending, are replaced
+    in the background while the others are used. Other keyword
+    arguments are passed on to client_class.
+
+    Notifications, and requests that are not waited for and have no
+    deadline, are not counted as load. The responses to requests that
+    are not waited for are handled by the dispatch_response() of the
+    connection the request was sent over, and the request ids are
+    those of that connection."""
+
+    client_class = rpc.RPCClient
+    connect_timeout = 10.0
+    retry_delay = 1.0
+
+    clients = ()
+
+    def __init__(self, addresses, size=2, client_class=None, warm=True, name=None, **kw):
+        if isinstance(addresses, tuple) and isinstance(addresses[0], basestring):
+            addresses = [addresses]
+        if client_class is not None:
+            self.client_class = client_class
+        for option in ('connect_timeout', 'retry_delay'):
+            if option in kw:
+                setattr(self, option, kw.pop(option))
+        self.name = name or type(self).__name__
+        self.client_kw = kw
+        self.addresses = [tuple(address) for address in addresses for n in xrange(size)]
+        self.clients = [None] * len(self.addresses)
+        self._lock = threading.Lock()
+        self._reconnecting = set()
+        self._next = itertools.count()
+        self._closed = False
+        if warm:
+            self.warm_up()
+
+    def connect(self, address):
+        """Returns a new connection to address."""
+        s = socket.create_connection(address, self.connect_timeout)
+        s.settimeout(None)
+        return self.client_class(s, name="%s/%s:%s" % (self.name, address[0], address[1]), **self.client_kw)
+
+    def _alive(self, client):
+        return (client is not None and client.isAlive()
+                and not client._shutdown and not client._closed)
+
+    def _open(self, index):
+        client = self.connect(self.addresses[index])
+        with self._lock:
+            old = self.clients[index]
+            if self._closed or self._alive(old):
+                # Shut down, or opened by another thread meanwhile
+                replaced = client
+                client = not self._closed and old or None
+            else:
+                replaced = old
+                self.clients[index] = client
+        if replaced is not None:
+            replaced.shutdown()
+        if client is None:
+            raise EOFError()
+        return client
+
+    def warm_up(self):
+        """Opens the connections that are missing or have died, and
+        returns the number of live connections. If there are none,
+        raises the error of the last one that could not be opened."""
+        error = None
+        for index, client in enumerate(self.clients):
+            if not self._alive(client):
+                try:
+                    self._open(index)
+                except socket.error, e:
+                    error = e
+        live = len([client for client in self.clients if self._alive(client)])
+        if not live and error is not None:
+            raise error
+        return live
+
+    def _replace(self, index):
+        with self._lock:
+            if self._closed or index in self._reconnecting:
+                return
+            self._reconnecting.add(index)
+        thread = threading.Thread(target=self._reconnect, args=(index,),
+                                  name="%s/reconnect/%s" % (self.name, index))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _reconnect(self, index):
+        try:
+            while not self._closed:
+                try:
+                    self._open(index)
+                    return
+                except socket.error:
+                    time.sleep(self.retry_delay)
+        finally:
+            with self._lock:
+                self._reconnecting.discard(index)
+
+    def client(self):
+        """Returns the live connection with the fewest requests
+        waiting for responses, opening one if there are none."""
+        if self._closed:
+            raise EOFError()
+        best = None
+        count = len(self.clients)
+        start = self._next.next()
+        # Start at a different connection each time, so that ties are
+        # spread over all of them.
+        for n in xrange(count):
+            index = (start + n) % count
+            client = self.clients[index]
+            if client is None:
+                continue
+            if not self._alive(client):
+                self._replace(index)
+                continue
+            load = client.pending_requests()
+            if best is None or load < best_load:
+                best, best_load = client, load
+                if not load:
+                    break
+        if best is None:
+            best = self._open_any()
+        return best
+
+    def _open_any(self):
+        error = None
+        for index in xrange(len(self.clients)):
+            try:
+                return self._open(index)
+            except socket.error, e:
+                error = e
+        raise error
+
+    def discard(self, client):
+        """Closes the connection client and replaces it in the
+        background."""
+        with self._lock:
+            if client not in self.clients:
+                return
+            index = self.clients.index(client)
+        client.shutdown()
+        self._replace(index)
+
+    def _call(self, name, *arg):
+        client = self.client()
+        try:
+            return getattr(client, name)(*arg)
+        except (socket.error, EOFError):
+            self.discard(client)
+            raise
+
+    def request(self, method, params=[], wait_for_response=False, timeout=None):
+        """Sends a request over the least loaded connection; see
+        RPCClient.request()."""
+        return self._call('request', method, params, wait_for_response, timeout)
+
+    def request_async(self, method, params=[], timeout=None):
+        """Sends a request over the least loaded connection; see
+        RPCClient.request_async()."""
+        return self._call('request_async', method, params, timeout)
+
+    def notify(self, method, params=[]):
+        self._call('notify', method, params)
+
+    def batch(self):
+        """Returns a Batch, to be sent over the least loaded
+        connection."""
+        return self.client().batch()
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            clients = [client for client in self.clients if client is not None]
+        for client in clients:
+            client.shutdown()
+
+    def join(self, timeout=None):
+        for client in list(self.clients):
+            if client is not None:
+                client.join(timeout)
+
+    def __getattr__(self, name):
+        def rpc_wrapper(*arg):
+            return self.request(name, list(arg), wait_for_response=True)
+        return rpc_wrapper
+
+
+#### Test code ####
+
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        registry = methods.MethodRegistry()
+        @registry.register
+        def ping():
+            return "pong"
+        @registry.register
+        def wait():
+            self.release.wait()
+            return "done"
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(('localhost', 0))
+        self.server_socket.listen(16)
+        self.address = self.server_socket.getsockname()
+        self.server = rpc.RPCServer(self.server_socket, name="PoolServer", methods=registry)
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.join()
+
+    def test_least_loaded(self):
+        pool = RPCClientPool(self.address, size=3, retry_delay=0.05)
+        try:
+            self.assertEqual(len([client for client in pool.clients if client.isAlive()]), 3)
+            fs = [pool.request_async("wait") for n in xrange(3)]
+            self.assertEqual([client.pending_requests() for client in pool.clients], [1, 1, 1])
+            self.assertEqual(pool.ping(), "pong")
+            self.release.set()
+            self.assertEqual([f.result(5) for f in fs], ["done"] * 3)
+        finally:
+            pool.shutdown()
+            pool.join()
+
+    def test_replace(self):
+        pool = RPCClientPool([self.address], size=2, warm=False, retry_delay=0.05)
+        try:
+            self.assertEqual(pool.clients, [None, None])
+            self.assertEqual(pool.ping(), "pong")
+            self.assertEqual(pool.warm_up(), 2)
+            dead = pool.clients[0]
+            dead.shutdown()
+            dead.join()
+            for n in xrange(4):
+                self.assertEqual(pool.ping(), "pong")
+            for n in xrange(50):
+                if pool.clients[0] is not dead and pool._alive(pool.clients[0]):
+                    break
+                time.sleep(0.05)
+            self.assertTrue(pool._alive(pool.clients[0]))
+            self.assertTrue(pool.clients[0] is not dead)
+        finally:
+            pool.shutdown()
+            pool.join()
+        self.assertRaises(EOFError, pool.client)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""A pre-forking launcher, running a server in several worker
+processes sharing one port, so that more than one core can be used."""
+
+import errno
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import time
+import traceback
+import unittest
+
+import rpc
+
+# Not defined by the socket module of Python 2; this is the Linux
+# value.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+def make_server_socket(address, reuse_port=False, backlog=128):
+    """Returns a TCP socket listening on address."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    s.bind(address)
+    s.listen(backlog)
+    return s
+
+class PreforkServer(object):
+    """Runs a server in processes worker processes, and restarts
+    them if they die.
+
+    server_factory is called with a listening socket in each worker,
+    and should return a started server, such as an instance of an
+    RPCServer subclass; the class itself can be passed. When the
+    worker gets SIGTERM, the shutdown() method of the server is
+    called, and the worker exits once join() returns.
+
+    By default the socket is created and bound to address by the
+    launcher and inherited by the workers. With reuse_port, each
+    worker binds a socket of its own using SO_REUSEPORT, which lets
+    the kernel balance the connections between them.
+
+    Workers are forked one at a time, each once the previous one
+    has created its server (or ready_timeout seconds have passed), so
+    that connections are accepted once start() returns.
+
+    Call start() and then run() from the main thread; run() returns
+    once the launcher gets SIGTERM or SIGINT and all workers have
+    exited."""
+
+    poll_interval = 0.5
+    restart_delay = 1.0
+    ready_timeout = 10.0
+
+    def __init__(self, server_factory, address=('', 4712), processes=None, reuse_port=False, backlog=128):
+        self.server_factory = server_factory
+        self.address = address
+        self.processes = processes or multiprocessing.cpu_count()
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.sock = None
+        self.workers = {}
+        self._started = {}
+        self._stopping = False
+
+    def start(self):
+        """Binds the socket, unless reuse_port is set, and forks the
+        workers."""
+        if not self.reuse_port:
+            self.sock = make_server_socket(self.address, backlog=self.backlog)
+            self.address = self.sock.getsockname()
+        elif self.address[1] == 0:
+            # Pick a port here, so that all workers use the same one.
+            s = make_server_socket(self.address, True, self.backlog)
+            self.address = s.getsockname()
+            s.close()
+        for index in xrange(self.processes):
+            self._fork(index)
+        return self
+
+    def _fork(self, index):
+        ready, ready_writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready)
+            status = 1
+            try:
+                try:
+                    self.run_worker(ready_writer)
+                    status = 0
+                except:
+                    traceback.print_exc()
+            finally:
+                os._exit(status)
+        os.close(ready_writer)
+        self.workers[pid] = index
+        self._started[index] = time.time()
+        try:
+            self._wait_ready(ready)
+        finally:
+            os.close(ready)
+
+    def _wait_ready(self, ready):
+        # The worker writes to the pipe once its server is created,
+        # and it is closed if the worker exits before that.
+        deadline = time.time() + self.ready_timeout
+        while True:
+            try:
+                readable, writable, failed = select.select([ready], [], [], max(0, deadline - time.time()))
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable:
+                os.read(ready, 1)
+            return
+
+    def run_worker(self, ready=None):
+        """Runs the server in a worker process until SIGTERM. Once
+        the server is created, a byte is written to the file
+        descriptor ready, if given."""
+        stop = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        sock = self.sock
+        if sock is None:
+            sock = make_server_socket(self.address, True, self.backlog)
+        server = self.server_factory(sock)
+        if ready is not None:
+            os.write(ready, 'r')
+            os.close(ready)
+        # Sleep rather than join, as joining can not be interrupted
+        # by signals.
+        while not stop and getattr(server, 'isAlive', lambda: True)():
+            time.sleep(self.poll_interval)
+        server.shutdown()
+        server.join()
+
+    def reap(self, block=True):
+        """Waits for a worker to exit, unless block is false, and
+        restarts those that have exited unless the launcher is
+        stopping. Returns False when there are no workers left."""
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, not block and os.WNOHANG or 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    return True
+                if e.errno == errno.ECHILD:
+                    self.workers.clear()
+                    break
+                raise
+            if pid == 0:
+                return True
+            index = self.workers.pop(pid, None)
+            if index is not None and not self._stopping:
+                if time.time() - self._started[index] < self.restart_delay:
+                    time.sleep(self.restart_delay)
+                self._fork(index)
+            block = False
+        return bool(self.workers)
+
+    def stop(self, wait=True):
+        """Asks all workers to shut down, and waits for them to exit
+        if wait is set."""
+        self._stopping = True
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+        if wait:
+            while self.reap():
+                pass
+            if self.sock is not None:
+                self.sock.close()
+
+    def run(self):
+        """Supervises the workers until SIGTERM or SIGINT, then stops
+        them."""
+        def stop(signum, frame):
+            self._stopping = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        while not self._stopping:
+            self.reap()
+        self.stop()
+
+
+#### Test code ####
+
+class TestPrefork(unittest.TestCase):
+    def _ping(self, address):
+        client = rpc.TestPingRPCClient(socket.create_connection(address))
+        try:
+            return client.ping()
+        finally:
+            client.shutdown()
+
+    def _test_prefork(self, reuse_port):
+        server = PreforkServer(rpc.TestPongRPCServer, ('localhost', 0), 2, reuse_port)
+        server.poll_interval = 0.05
+        server.restart_delay = 0
+        server.start()
+        try:
+            for n in xrange(4):
+                self.assertEqual(self._ping(server.address), "pong")
+            pid = server.workers.keys()[0]
+            os.kill(pid, signal.SIGKILL)
+            self.assertTrue(server.reap())
+            self.assertEqual(sorted(server.workers.values()), [0, 1])
+            self.assertFalse(pid in server.workers)
+            for n in xrange(4):
+                self.assertEqual(self._ping(server.address), "pong")
+        finally:
+            server.stop()
+        self.assertEqual(server.workers, {})
+
+    def test_inherited_socket(self):
+        self._test_prefork(False)
+
+    def test_reuse_port(self):
+        self._test_prefork(True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Hooks following messages through the stages of their handling.
+
+A hook is given to a ClientConnection or RPCServer (or ReactorServer)
+as the profile_hook keyword argument or class attribute. For every
+message read (kind "in") and every message sent on its own (kind
+"out"), the connection calls begin(), which returns a trace object,
+or None to leave the message alone. For each stage of the handling
+of a traced message, stage(trace, name, start, end) is then called
+with the time.time() the stage started and ended at, and finally
+end(trace). The stages are:
+
+    parse      reading and decoding the message, not counting the
+               time spent waiting for data
+    dispatch   waiting for a dispatcher thread to pick the message up
+    handler    the dispatch_request() or dispatch_notification() call
+    complete   completing the future of a response that is waited for
+    serialize  encoding the response, or the message sent
+    lock       waiting for other threads to finish writing
+    enqueue    queuing the text for the sender thread
+    write      writing the text, including waiting for the socket to
+               become writable
+
+Without a hook, none of this costs more than an attribute test per
+message."""
+
+from __future__ import with_statement
+
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+
+class ProfileHook(object):
+    """Base class for hooks, doing nothing."""
+
+    def begin(self, connection, kind):
+        return None
+
+    def stage(self, trace, name, start, end):
+        pass
+
+    def end(self, trace):
+        pass
+
+class Trace(object):
+    """The stages of one message, as recorded by the hooks of this
+    module."""
+
+    def __init__(self, connection, kind):
+        self.connection = connection
+        self.kind = kind
+        self.stages = []
+
+    def add(self, name, start, end):
+        self.stages.append((name, start, end))
+
+class PrintHook(ProfileHook):
+    """Prints the stages of every message as they happen, to follow
+    what a connection does."""
+
+    def begin(self, connection, kind):
+        return Trace(connection, kind)
+
+    def stage(self, trace, name, start, end):
+        print "%s: %s %s: %.6fs" % (trace.connection.getName(), trace.kind, name, end - start)
+
+class SamplingProfiler(ProfileHook):
+    """Traces a random sample of rate of the messages, and adds up
+    the time spent in each stage by kind of message.
+
+    Unless path is None, the breakdown is written to that file every
+    interval seconds, as messages complete, and by dump()."""
+
+    def __init__(self, path=None, rate=0.01, interval=10.0):
+        self.path = path
+        self.rate = rate
+        self.interval = interval
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.since = time.time()
+            self._dumped = self.since
+            self.messages = {}
+            self.stages = {}
+
+    def begin(self, connection, kind):
+        if self.rate < 1.0 and random.random() >= self.rate:
+            return None
+        return Trace(connection, kind)
+
+    def stage(self, trace, name, start, end):
+        trace.add(name, start, end)
+
+    def end(self, trace):
+        if not trace.stages:
+            return
+        total = max(end for name, start, end in trace.stages) - min(start for name, start, end in trace.stages)
+        dump = False
+        with self._lock:
+            self._add(self.messages, trace.kind, total)
+            for name, start, end in trace.stages:
+                self._add(self.stages, (trace.kind, name), end - start)
+            now = time.time()
+            if self.path is not None and now - self._dumped >= self.interval:
+                self._dumped = now
+                dump = True
+        if dump:
+            self.dump()
+
+    def _add(self, table, key, duration):
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+
+    def breakdown(self):
+        """Returns a list of (kind, stage, count, total, max) tuples,
+        where stage is None for the totals of whole messages."""
+        with self._lock:
+            rows = [(kind, None) + tuple(stats) for kind, stats in self.messages.iteritems()]
+            rows.extend((kind, name) + tuple(stats) for (kind, name), stats in self.stages.iteritems())
+        rows.sort(key=lambda row: (row[0], row[1] is not None, -row[3]))
+        return rows
+
+    def text(self):
+        """Returns the breakdown as a table."""
+        lines = ["# %s, sampled since %s at a rate of %s" % (
+                    type(self).__name__, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.since)), self.rate),
+                 "%-4s %-10s %8s %12s %10s %10s %7s" % (
+                    "kind", "stage", "count", "total (s)", "mean (ms)", "max (ms)", "share")]
+        totals = {}
+        for kind, name, count, total, longest in self.breakdown():
+            if name is None:
+                totals[kind] = total
+                name = "(message)"
+            share = totals.get(kind) and total / totals[kind] * 100 or 0.0
+            lines.append("%-4s %-10s %8d %12.6f %10.3f %10.3f %6.1f%%" % (
+                kind, name, count, total, total / count * 1000, longest * 1000, share))
+        return ''.join(line + '\n' for line in lines)
+
+    def dump(self):
+        """Writes the breakdown to the file path."""
+        text = self.text()
+        # Write to a temporary file first, so that readers never see
+        # a partial breakdown.
+        fd, name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            os.write(fd, text)
+        finally:
+            os.close(fd)
+        os.rename(name, self.path)
+
+
+#### Test code ####
+
+class TestProfiling(unittest.TestCase):
+    def test_sampling_profiler(self):
+        path = tempfile.mktemp()
+        profiler = SamplingProfiler(path, rate=1.0, interval=0)
+        for n in xrange(2):
+            trace = profiler.begin(None, "in")
+            profiler.stage(trace, "parse", 10.0, 10.5)
+            profiler.stage(trace, "handler", 10.5, 11.0 + n)
+            profiler.end(trace)
+        self.assertEqual(profiler.breakdown(),
+                         [("in", None, 2, 3.0, 2.0),
+                          ("in", "handler", 2, 2.0, 1.5),
+                          ("in", "parse", 2, 1.0, 0.5)])
+        try:
+            text = open(path).read()
+        finally:
+            os.unlink(path)
+        self.assertTrue("in   handler           2     2.000000   1000.000   1500.000   66.7%\n" in text)
+
+        profiler = SamplingProfiler(rate=0.0)
+        self.assertEqual(profiler.begin(None, "in"), None)
+
+if __name__ == "__main__":
+    unittest.main()
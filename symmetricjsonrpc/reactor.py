@@ -0,0 +1,887 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""An event driven implementation of the symmetric JSON-RPC model,
+serving any number of connections from a single thread.
+
+A Reactor multiplexes non-blocking sockets using select.epoll (or
+select.poll where epoll is not available). Each connected socket is
+handled by a Transport, which passes the data it receives to a
+Protocol. RPCProtocol is a Protocol implementing JSON-RPC; it speaks
+the same protocol as rpc.RPCClient, so the two can be connected to
+each other.
+
+ReactorServer serves the connections of an rpc.RPCServer subclass
+from reactors instead of from threads of their own, keeping the
+RPCServer API."""
+
+from __future__ import with_statement
+
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import select
+import socket
+import thread
+import threading
+import time
+import traceback
+import unittest
+
+import dispatcher
+import futures
+import rpc
+import timers
+
+READ = select.POLLIN | select.POLLPRI
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+_would_block = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+class Reactor(object):
+    """An event loop calling handlers registered for file
+    descriptors when they become readable or writable.
+
+    A handler is an object with a handle_events(mask) method, where
+    mask is a combination of READ, WRITE and ERROR. Handlers are run
+    in the thread running run(), which is started by start(). Use
+    call_soon() to have any other code run in that thread; it is the
+    only method that is safe to call from other threads."""
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poll = select.epoll()
+            self._timeout_scale = 1.0
+        else:
+            self._poll = select.poll()
+            self._timeout_scale = 1000.0
+        self._handlers = {}
+        self._calls = collections.deque()
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._running = False
+        self._thread_ident = None
+        self.thread = None
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        _set_nonblocking(self._wakeup_read)
+        _set_nonblocking(self._wakeup_write)
+        self.register(self._wakeup_read, self, READ)
+
+    def register(self, fd, handler, events):
+        self._handlers[fd] = handler
+        self._poll.register(fd, events | ERROR)
+
+    def modify(self, fd, events):
+        self._poll.modify(fd, events | ERROR)
+
+    def unregister(self, fd):
+        if self._handlers.pop(fd, None) is not None:
+            self._poll.unregister(fd)
+
+    def in_reactor_thread(self):
+        return self._thread_ident == thread.get_ident()
+
+    def call_soon(self, fn, *arg):
+        """Calls fn(*arg) from the reactor thread."""
+        self._calls.append((fn, arg))
+        if not self.in_reactor_thread():
+            self._wakeup()
+
+    def call_later(self, delay, fn, *arg):
+        """Calls fn(*arg) from the reactor thread after delay
+        seconds. Must be called from the reactor thread."""
+        heapq.heappush(self._timers, (time.time() + delay, self._timer_ids.next(), fn, arg))
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError, e:
+            if e.errno not in _would_block:
+                raise
+
+    def handle_events(self, mask):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in _would_block:
+                raise
+
+    def start(self):
+        """Runs the reactor in a new daemon thread."""
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Makes run() return after the current iteration."""
+        def stop():
+            self._running = False
+        self.call_soon(stop)
+
+    def close(self):
+        """Releases the resources of a reactor that is not running."""
+        self._poll.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def run(self):
+        self._thread_ident = thread.get_ident()
+        self._running = True
+        while self._running:
+            timeout = -1
+            if self._calls:
+                timeout = 0
+            elif self._timers:
+                timeout = max(0, self._timers[0][0] - time.time())
+            try:
+                events = self._poll.poll(timeout * self._timeout_scale)
+            except (select.error, IOError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, mask in events:
+                handler = self._handlers.get(fd)
+                if handler is None:
+                    continue
+                try:
+                    handler.handle_events(mask)
+                except Exception:
+                    traceback.print_exc()
+                    if hasattr(handler, 'close'):
+                        handler.close()
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                when, timer_id, fn, arg = heapq.heappop(self._timers)
+                self._calls.append((fn, arg))
+            for n in xrange(len(self._calls)):
+                fn, arg = self._calls.popleft()
+                try:
+                    fn(*arg)
+                except Exception:
+                    traceback.print_exc()
+
+class Protocol(object):
+    """Base class for protocols, receiving the events of a
+    Transport."""
+
+    transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        pass
+
+    def connection_lost(self, exc):
+        """Called when the connection has been closed; exc is None on
+        a clean EOF or close()."""
+        pass
+
+class Transport(object):
+    """A connected non-blocking socket handled by a reactor, passing
+    any data received to a protocol.
+
+    write() and close() are safe to call from any thread. Data that
+    can not be sent right away is buffered and sent as the socket
+    becomes writable."""
+
+    read_size = 65536
+
+    def __init__(self, reactor, sock, protocol):
+        self.reactor = reactor
+        self.sock = sock
+        self.protocol = protocol
+        self.fd = sock.fileno()
+        sock.setblocking(False)
+        self._out = collections.deque()
+        self._out_offset = 0
+        self._out_size = 0
+        self._lock = threading.Lock()
+        self._closing = False
+        self.closed = False
+        protocol.connection_made(self)
+        reactor.call_soon(self._register)
+
+    def _register(self):
+        if self.closed:
+            return
+        events = READ
+        if self._out:
+            events |= WRITE
+        self.reactor.register(self.fd, self, events)
+
+    def get_write_buffer_size(self):
+        return self._out_size
+
+    def write(self, data):
+        with self._lock:
+            if self.closed or self._closing:
+                raise EOFError
+            was_empty = not self._out
+            self._out.append(data)
+            self._out_size += len(data)
+            if was_empty:
+                try:
+                    self._send()
+                except socket.error, e:
+                    self.reactor.call_soon(self._close, e)
+                    return
+                if self._out:
+                    self.reactor.call_soon(self._want_write)
+
+    def _send(self):
+        """Sends as much buffered data as possible. Must be called
+        with the lock held."""
+        while self._out:
+            data = self._out[0]
+            if self._out_offset:
+                data = buffer(data, self._out_offset)
+            try:
+                sent = self.sock.send(data)
+            except socket.error, e:
+                if e.args[0] in _would_block:
+                    return
+                raise
+            self._out_offset += sent
+            self._out_size -= sent
+            if sent < len(data):
+                return
+            self._out.popleft()
+            self._out_offset = 0
+
+    def _want_write(self):
+        if not self.closed and self.fd in self.reactor._handlers:
+            self.reactor.modify(self.fd, READ | WRITE)
+
+    def handle_events(self, mask):
+        if mask & WRITE:
+            with self._lock:
+                try:
+                    self._send()
+                except socket.error, e:
+                    self._close(e)
+                    return
+                done = not self._out
+            if done:
+                if self._closing:
+                    self._close(None)
+                    return
+                self.reactor.modify(self.fd, READ)
+        if mask & (READ | ERROR):
+            try:
+                data = self.sock.recv(self.read_size)
+            except socket.error, e:
+                if e.args[0] in _would_block:
+                    return
+                self._close(e)
+                return
+            if not data:
+                self._close(None)
+                return
+            self.protocol.data_received(data)
+
+    def close(self):
+        """Closes the connection once all buffered data has been
+        sent."""
+        with self._lock:
+            self._closing = True
+            if self._out:
+                return
+        self.reactor.call_soon(self._close, None)
+
+    def _close(self, exc):
+        if self.closed:
+            return
+        self.closed = True
+        self.reactor.unregister(self.fd)
+        self.sock.close()
+        self.protocol.connection_lost(exc)
+
+class Listener(object):
+    """Accepts connections on a listening socket, creating a
+    Transport for each one, with a protocol from protocol_factory()."""
+
+    def __init__(self, reactor, sock, protocol_factory):
+        self.reactor = reactor
+        self.sock = sock
+        self.protocol_factory = protocol_factory
+        sock.setblocking(False)
+        reactor.call_soon(reactor.register, sock.fileno(), self, READ)
+
+    def handle_events(self, mask):
+        while True:
+            try:
+                sock, address = self.sock.accept()
+            except socket.error, e:
+                if e.args[0] in _would_block + (errno.ECONNABORTED,):
+                    return
+                raise
+            self.accepted(sock, address)
+
+    def accepted(self, sock, address):
+        Transport(self.reactor, sock, self.protocol_factory())
+
+    def close(self):
+        def close():
+            self.reactor.unregister(self.sock.fileno())
+            self.sock.close()
+        self.reactor.call_soon(close)
+
+class RPCProtocol(Protocol):
+    """A JSON RPC endpoint running in a reactor.
+
+    Like rpc.RPCClient, it represents one end of a connection, and can
+    both issue requests and notifications and handle incoming ones.
+    Messages are read and written with the codec given to the
+    constructor or set as the codec class attribute, defaulting to
+    rpc.default_codec.
+
+    request() returns a futures.Future for the result instead of
+    blocking. Incoming messages are handled by dispatch_request(),
+    dispatch_notification() and dispatch_response(), which are called
+    in the reactor thread and so must not block. dispatch_request()
+    may return a futures.Future, in which case the response is sent
+    when it completes. By default they call the methods of the
+    methods.MethodRegistry given to the constructor or set as the
+    methods class attribute, if any.
+
+    Requests are given deadlines the same way as by rpc.RPCClient,
+    with request_timeout and timer_wheel, but expire in the reactor
+    thread. Responses to requests that have expired or been abandoned
+    are dropped."""
+
+    codec = None
+    methods = None
+    request_timeout = None
+    timer_wheel = None
+    late_response_window = 60.0
+
+    def __init__(self, codec=None, methods=None, request_timeout=None, timer_wheel=None):
+        if codec is not None:
+            self.codec = codec
+        if methods is not None:
+            self.methods = methods
+        if request_timeout is not None:
+            self.request_timeout = request_timeout
+        if timer_wheel is not None:
+            self.timer_wheel = timer_wheel
+        if self.codec is None:
+            self.codec = rpc.default_codec
+        if self.timer_wheel is None:
+            self.timer_wheel = timers.default_wheel()
+        self.framer = self.codec.framer()
+        self.writer = self.codec.writer(None)
+        self._request_ids = itertools.count(1)
+        self._recv_waiting = {}
+        self._late = rpc.LateResponses(self.late_response_window)
+
+    def data_received(self, data):
+        for text in self.framer.split(data):
+            self.dispatch(self.codec.decode(text))
+
+    def connection_lost(self, exc):
+        for text in self.framer.close():
+            self.dispatch(self.codec.decode(text))
+        waiting, self._recv_waiting = self._recv_waiting, {}
+        for future in waiting.itervalues():
+            if future.timer is not None:
+                future.timer.cancel()
+            future.set_exception(exc or EOFError())
+
+    def send(self, value):
+        self.transport.write(self.writer.encode(value))
+
+    def request(self, method, params=[], timeout=None):
+        """Sends a request and returns a futures.Future for its
+        result, failed with rpc.RequestTimeout after timeout seconds,
+        or request_timeout."""
+        future, message = self.prepare_request(method, params, timeout)
+        try:
+            self.send(message)
+        except:
+            self.abandon(future)
+            raise
+        return future
+
+    def prepare_request(self, method, params=[], timeout=None):
+        future = futures.Future()
+        future.request_id = self._request_ids.next()
+        future.method = method
+        future.timer = None
+        self._recv_waiting[future.request_id] = future
+        if timeout is None:
+            timeout = self.request_timeout
+        if timeout is not None:
+            try:
+                future.timer = self.timer_wheel.schedule(timeout, self.transport.reactor.call_soon, self.expire, future)
+            except:
+                self._take_request(future.request_id)
+                raise
+        return future, {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': future.request_id}
+
+    def _take_request(self, request_id):
+        future = self._recv_waiting.pop(request_id, None)
+        if future is not None and future.timer is not None:
+            future.timer.cancel()
+        return future
+
+    def abandon(self, future):
+        if self._take_request(future.request_id) is not None:
+            self._late.add(future.request_id, future.method)
+
+    def expire(self, future):
+        """Fails the request of future with rpc.RequestTimeout,
+        unless its response has already arrived."""
+        if self._take_request(future.request_id) is not None:
+            self._late.add(future.request_id, future.method)
+            future.set_exception(rpc.RequestTimeout("No response to %s request %s" % (future.method, future.request_id)))
+
+    def batch(self):
+        """Returns an rpc.Batch, collecting requests and
+        notifications to send together."""
+        return rpc.Batch(self)
+
+    def notify(self, method, params=[]):
+        self.send({'method': method, 'params': params})
+
+    def response(self, result, error, id):
+        return {'result': result, 'error': error, 'id': id}
+
+    def respond(self, result, error, id):
+        self.send(self.response(result, error, id))
+
+    def close(self):
+        self.transport.close()
+
+    def dispatch(self, subject):
+        if isinstance(subject, list):
+            self.dispatch_batch(subject)
+            return
+        answer = self._handle(subject)
+        if isinstance(answer, futures.Future):
+            answer.add_done_callback(lambda future: self.respond(*future.result()))
+        elif answer is not None:
+            self.respond(*answer)
+
+    def handle(self, subject):
+        """Handles a single message, and returns the response to
+        send for it, if any, or a futures.Future for it."""
+        answer = self._handle(subject)
+        if isinstance(answer, futures.Future):
+            response = futures.Future()
+            answer.add_done_callback(lambda future: response.set_result(self.response(*future.result())))
+            return response
+        if answer is not None:
+            return self.response(*answer)
+
+    def _handle(self, subject):
+        # Returns the result, error and id to respond with, if any,
+        # or a futures.Future for them.
+        if not isinstance(subject, dict):
+            return None, rpc.exception_error(ValueError("Invalid request", subject)), None
+        if 'method' in subject and 'id' in subject:
+            try:
+                result = self.dispatch_request(subject)
+            except Exception, e:
+                return None, rpc.exception_error(e), subject['id']
+            if isinstance(result, futures.Future):
+                answer = futures.Future()
+                result.add_done_callback(
+                    lambda future: answer.set_result(self._future_answer(future, subject['id'])))
+                return answer
+            return result, None, subject['id']
+        elif 'result' in subject or 'error' in subject:
+            request_id = subject.get('id')
+            if isinstance(request_id, (basestring, int, long)):
+                future = self._take_request(request_id)
+                if future is not None:
+                    rpc.complete_future(future, subject)
+                    return
+                if self._late.pop(request_id) is not None:
+                    return
+            self.dispatch_response(subject)
+        elif 'method' in subject:
+            try:
+                self.dispatch_notification(subject)
+            except:
+                traceback.print_exc()
+
+    def dispatch_batch(self, subjects):
+        """Handles the messages of a batch, and sends their
+        responses as one array once all of them are available."""
+        if not subjects:
+            self.send([self.response(None, rpc.exception_error(ValueError("Empty batch")), None)])
+            return
+        responses = [self.handle(subject) for subject in subjects]
+        pending = [response for response in responses if isinstance(response, futures.Future)]
+        # The futures can complete in different threads at once.
+        lock = threading.Lock()
+        def send_responses(future=None):
+            if future is not None:
+                with lock:
+                    pending.remove(future)
+                    if pending:
+                        return
+            results = [isinstance(response, futures.Future) and response.result() or response
+                       for response in responses]
+            results = [response for response in results if response is not None]
+            if results:
+                self.send(results)
+        if not pending:
+            send_responses()
+        for future in list(pending):
+            future.add_done_callback(send_responses)
+
+    def _future_answer(self, future, id):
+        if future.exception() is not None:
+            return None, rpc.exception_error(future.exception()), id
+        return future.result(), None, id
+
+    def dispatch_request(self, subject):
+        if self.methods is not None:
+            return self.methods.call(self, subject)
+
+    def dispatch_notification(self, subject):
+        if self.methods is not None:
+            self.methods.call(self, subject)
+
+    def dispatch_response(self, subject):
+        """Note: Only used to results for calls that nothing is
+        waiting for"""
+        pass
+
+class TransportWriter(object):
+    """Writes messages encoded with a codec writer to a Transport.
+    It has the part of the interface of codec.CodecWriter that
+    rpc.ClientConnection uses."""
+
+    def __init__(self, writer, transport):
+        self.writer = writer
+        self.transport = transport
+
+    def encode(self, value):
+        return self.writer.encode(value)
+
+    def write_encoded(self, texts):
+        self.transport.write(''.join(texts))
+
+    def write_value(self, value):
+        self.transport.write(self.encode(value))
+
+    def close(self):
+        self.transport.close()
+
+class ReactorConnection(Protocol):
+    """Mixed into an rpc.RPCClient subclass by ReactorServer, this
+    makes its instances protocols run by a reactor, instead of
+    threads reading their connections. Responses that are waited for
+    are completed in the reactor thread, and everything else is
+    dispatched to the dispatch_executor of the connection."""
+
+    def _init(self, subject, parent=None, *arg, **kw):
+        kw['defer_decoding'] = False
+        kw['threaded_send'] = False
+        super(ReactorConnection, self)._init(subject, parent, *arg, **kw)
+        self.reader = None
+        self.framer = self.codec.framer()
+        # The connection is never started as a thread, so let join()
+        # wait for the connection to be lost instead.
+        self._inline_done = threading.Event()
+
+    def connection_made(self, transport):
+        Protocol.connection_made(self, transport)
+        self.writer = TransportWriter(self.codec.writer(None), transport)
+
+    def data_received(self, data):
+        texts = self.framer.split(data)
+        if self.metrics is not None:
+            self.metrics.count('connection_bytes_in', self.metrics_label, len(data))
+            self.metrics.count('connection_messages_in', self.metrics_label, len(texts))
+        if self.profile_hook is not None:
+            self._dispatch_traced(texts)
+            return
+        for text in texts:
+            self.dispatch(self.codec.decode(text))
+
+    def _dispatch_traced(self, texts):
+        for text in texts:
+            start = time.time()
+            value = self.codec.decode(text)
+            self._read_trace = trace = self.profile_hook.begin(self, "in")
+            if trace is not None:
+                self.profile_hook.stage(trace, "parse", start, time.time())
+            try:
+                self.dispatch(value)
+            finally:
+                self._read_trace = None
+
+    def connection_lost(self, exc):
+        for text in self.framer.close():
+            self.dispatch(self.codec.decode(text))
+        self._fail_pending(exc or EOFError())
+        self._shutdown = True
+        if self.metrics is not None:
+            self.metrics.count('connection_closed', self.metrics_label)
+        if hasattr(self.parent, "children") and self in self.parent.children:
+            self.parent.children.remove(self)
+        self._inline_done.set()
+
+    def shutdown(self):
+        if self.transport is not None:
+            self.transport.close()
+        dispatcher.Connection.shutdown(self)
+
+_connection_classes = {}
+
+def reactor_connection_class(cls):
+    """Returns a subclass of cls, an rpc.RPCClient subclass, with
+    ReactorConnection mixed in."""
+    if cls not in _connection_classes:
+        _connection_classes[cls] = type(cls.__name__, (ReactorConnection, cls), {})
+    return _connection_classes[cls]
+
+class ReactorServer(Listener):
+    """Serves the connections accepted on sock like server_class, an
+    rpc.RPCServer subclass, would, but from one or more reactors
+    instead of two threads per connection.
+
+    Each connection is an instance of the
+    server_class.InboundConnection.Thread class, so its Request
+    dispatchers and run_parent() work as with server_class, and are
+    run by the workers of dispatch_executor. Unless one is given, a
+    dispatcher.ThreadPool with an unbounded queue is used; a bounded
+    queue would block the reactors when it is full.
+
+    reactor is either a Reactor, or a list of reactors to spread the
+    connections over. The codec, methods.MethodRegistry,
+    metrics.Metrics registry, metrics_method, profile_hook,
+    request_timeout and timer_wheel used default to those of
+    server_class."""
+
+    def __init__(self, reactor, sock, server_class=rpc.RPCServer, dispatch_executor=None, codec=None, name=None,
+                 methods=None, metrics=None, metrics_method=None, profile_hook=None, request_timeout=None,
+                 timer_wheel=None):
+        if isinstance(reactor, Reactor):
+            reactor = [reactor]
+        self.reactors = list(reactor)
+        self._next_reactor = itertools.cycle(self.reactors).next
+        self.server_class = server_class
+        self.connection_class = reactor_connection_class(server_class.InboundConnection.Thread)
+        options = {'codec': codec, 'methods': methods, 'metrics': metrics, 'metrics_method': metrics_method,
+                   'profile_hook': profile_hook, 'request_timeout': request_timeout, 'timer_wheel': timer_wheel}
+        for option, value in options.iteritems():
+            if value is None:
+                value = getattr(server_class, option)
+            setattr(self, option, value)
+        self.name = name or server_class.__name__
+        self._own_executor = dispatch_executor is None
+        if dispatch_executor is None:
+            dispatch_executor = dispatcher.ThreadPool(name="%s/ThreadPool" % self.name)
+        self.dispatch_executor = dispatch_executor
+        self.parent = None
+        self.children = []
+        Listener.__init__(self, self.reactors[0], sock, None)
+
+    def getName(self):
+        return self.name
+
+    def accepted(self, sock, address):
+        connection = self.connection_class.__new__(self.connection_class)
+        connection._init(sock, parent=self, dispatch_executor=self.dispatch_executor)
+        Transport(self._next_reactor(), sock, connection)
+        self.dispatch_executor.submit(connection.run_parent)
+
+    def shutdown(self):
+        """Stops accepting connections and closes the open ones."""
+        self.close()
+        for child in list(self.children):
+            child.shutdown()
+
+    def join(self, timeout=None):
+        """Waits for the connections to be closed."""
+        for child in list(self.children):
+            child.join(timeout)
+        if self._own_executor:
+            self.dispatch_executor.shutdown()
+
+
+#### Test code ####
+
+class TestPongRPCProtocol(RPCProtocol):
+    def dispatch_request(self, subject):
+        assert subject['method'] == "ping"
+        result = futures.Future()
+        def pingpong(future):
+            if future.result() == "pingpong":
+                result.set_result("pong")
+            else:
+                result.set_exception(Exception(future.result()))
+        self.request("pingping").add_done_callback(pingpong)
+        return result
+
+class TestPingRPCProtocol(RPCProtocol):
+    def dispatch_request(self, subject):
+        assert subject['method'] == "pingping"
+        return "pingpong"
+
+def test_make_server_socket():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(('localhost', 0))
+    s.listen(128)
+    return s
+
+class TestReactor(unittest.TestCase):
+    def setUp(self):
+        self.reactor = Reactor().start()
+
+    def tearDown(self):
+        self.reactor.stop()
+        self.reactor.thread.join()
+        self.reactor.close()
+
+    def test_call_later(self):
+        results = []
+        done = threading.Event()
+        def later():
+            self.reactor.call_later(0.02, lambda: (results.append(2), done.set()))
+            self.reactor.call_later(0.01, results.append, 1)
+        self.reactor.call_soon(later)
+        done.wait(1)
+        self.assertEqual(results, [1, 2])
+
+    def test_protocols(self):
+        server_socket = test_make_server_socket()
+        Listener(self.reactor, server_socket, TestPongRPCProtocol)
+        clients = []
+        for n in xrange(50):
+            client = TestPingRPCProtocol()
+            Transport(self.reactor, socket.create_connection(server_socket.getsockname()), client)
+            clients.append(client)
+        fs = [client.request("ping") for client in clients]
+        self.assertEqual([f.result(5) for f in fs], ["pong"] * 50)
+        error = clients[0].request("pingping")
+        self.assertRaises(rpc.RPCError, lambda: error.result(5))
+        for client in clients:
+            client.close()
+
+    def test_threaded_client(self):
+        server_socket = test_make_server_socket()
+        Listener(self.reactor, server_socket, TestPongRPCProtocol)
+        client = rpc.TestPingRPCClient(socket.create_connection(server_socket.getsockname()))
+        self.assertEqual(client.ping(), "pong")
+        client.shutdown()
+
+    def test_threaded_server(self):
+        server_socket = test_make_server_socket()
+        server = rpc.TestPongRPCServer(server_socket, name="PongServer")
+        client = TestPingRPCProtocol()
+        Transport(self.reactor, socket.create_connection(server_socket.getsockname()), client)
+        self.assertEqual(client.request("ping").result(5), "pong")
+        client.close()
+        server.shutdown()
+        server.join()
+
+    def test_reactor_server(self):
+        server_socket = test_make_server_socket()
+        other = Reactor().start()
+        server = ReactorServer([self.reactor, other], server_socket, rpc.TestPongRPCServer)
+        self.assertEqual(server.getName(), "TestPongRPCServer")
+        clients = [rpc.TestPingRPCClient(socket.create_connection(server_socket.getsockname()))
+                   for n in xrange(10)]
+        self.assertEqual([client.ping() for client in clients], ["pong"] * 10)
+        self.assertEqual(len(server.children), 10)
+        for client in clients:
+            client.shutdown()
+        server.shutdown()
+        server.join(5)
+        self.assertEqual(server.children, [])
+        other.stop()
+        other.thread.join()
+        other.close()
+
+    def test_batch(self):
+        server_socket = test_make_server_socket()
+        Listener(self.reactor, server_socket, TestPongRPCProtocol)
+        client = TestPingRPCProtocol()
+        Transport(self.reactor, socket.create_connection(server_socket.getsockname()), client)
+        with client.batch() as batch:
+            pings = [batch.request("ping") for n in xrange(5)]
+            error = batch.request("pingping")
+        self.assertEqual([f.result(5) for f in pings], ["pong"] * 5)
+        self.assertRaises(rpc.RPCError, lambda: error.result(5))
+        client.close()
+
+        server = rpc.TestPingRPCClient(socket.create_connection(server_socket.getsockname()))
+        with server.batch() as batch:
+            pings = [batch.request("ping") for n in xrange(5)]
+        self.assertEqual([f.result(5) for f in pings], ["pong"] * 5)
+        server.shutdown()
+
+    def test_connection_lost(self):
+        sockets = socket.socketpair()
+        client = RPCProtocol()
+        Transport(self.reactor, sockets[0], client)
+        future = client.request("ping")
+        sockets[1].close()
+        self.assertRaises((EOFError, socket.error), lambda: future.result(5))
+
+    def test_request_timeout(self):
+        sockets = socket.socketpair()
+        responses = []
+        class Client(RPCProtocol):
+            def dispatch_response(self, subject):
+                responses.append(subject)
+        client = Client(request_timeout=0.05)
+        Transport(self.reactor, sockets[0], client)
+        future = client.request("ping")
+        in_reactor = []
+        done = threading.Event()
+        future.add_done_callback(lambda future: (in_reactor.append(self.reactor.in_reactor_thread()), done.set()))
+        self.assertRaises(rpc.RequestTimeout, lambda: future.result(5))
+        done.wait(5)
+        self.assertEqual(in_reactor, [True])
+        self.assertEqual(client._recv_waiting, {})
+
+        # The late response is dropped, unlike an unknown one
+        sockets[1].sendall('{"result": "pong", "error": null, "id": %s}' % future.request_id)
+        sockets[1].sendall('{"result": "pong", "error": null, "id": 4711}')
+        for n in xrange(100):
+            if responses:
+                break
+            time.sleep(0.01)
+        self.assertEqual([response['id'] for response in responses], [4711])
+        client.close()
+        sockets[1].close()
+
+if __name__ == "__main__":
+    unittest.main()
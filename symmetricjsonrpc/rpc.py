@@ -25,32 +25,434 @@
 
 from __future__ import with_statement
 
+import StringIO
+import itertools
 import select
 import socket
+import sys
 import threading
 import time
 import traceback
 import unittest
 
+import codec
 import dispatcher
+import framing
+import futures
 import json
+import methods
+import metrics
+import profiling
+import timers
+
+default_codec = codec.PythonCodec()
+
+def find_inherited(thread, name, default=None):
+    """Returns the attribute name of thread or the closest of its
+    parents that has it set, or default."""
+    while thread is not None:
+        if getattr(thread, name, None) is not None:
+            return getattr(thread, name)
+        thread = getattr(thread, 'parent', None)
+    return default
+
+def find_codec(thread):
+    """Returns the codec attribute of thread or the closest of its
+    parents that has one set, or default_codec."""
+    return find_inherited(thread, 'codec', default_codec)
+
+class Sender(dispatcher.Thread):
+    """A thread writing the encoded messages queued for a connection
+    with put(). Everything queued while a write is in progress is
+    written together with the next single write.
+
+    When more than high_water bytes are queued, put() blocks until
+    the queue has been written. Once the sender is closed or has
+    stopped, put() raises EOFError, or the error writing failed with.
+    The subject is the writer to use.
+
+    If coalesce_window is set (as a keyword argument or class
+    attribute) to a number of seconds, a message is held back for up
+    to that long, so that messages put in the meantime can be written
+    along with it. The messages are written right away once
+    coalesce_count messages are queued (unless it is 0), or when
+    flush() is called."""
+
+    high_water = 1048576
+    coalesce_window = 0
+    coalesce_count = 0
+
+    def _init(self, subject, parent=None, *arg, **kw):
+        for name in ('coalesce_window', 'coalesce_count'):
+            if name in kw:
+                setattr(self, name, kw.pop(name))
+        self.queue = []
+        self.queued = 0
+        self.error = None
+        self._closing = False
+        self._stopped = False
+        self._flushing = False
+        self._first_queued = None
+        self._condition = threading.Condition()
+        dispatcher.Thread._init(self, subject=subject, parent=parent, *arg, **kw)
+
+    def put(self, text):
+        with self._condition:
+            while self.queued >= self.high_water and not self.error and not self._shutdown:
+                self._condition.wait()
+            if self.error:
+                raise self.error
+            if self._shutdown or self._closing or self._stopped:
+                raise EOFError
+            if not self.queue:
+                self._first_queued = time.time()
+            self.queue.append(text)
+            self.queued += len(text)
+            self._condition.notifyAll()
+
+    def flush(self):
+        """Makes the queued messages be written without waiting for
+        the end of the coalescing window."""
+        with self._condition:
+            if self.queue:
+                self._flushing = True
+                self._condition.notifyAll()
+
+    def _hold(self):
+        """Returns the number of seconds to go on holding back the
+        queued messages for, or None to write them now. Must be called
+        with the condition held."""
+        if not self.coalesce_window or self._flushing or self._closing or self._shutdown:
+            return None
+        if self.coalesce_count and len(self.queue) >= self.coalesce_count:
+            return None
+        remaining = self._first_queued + self.coalesce_window - time.time()
+        if remaining <= 0:
+            return None
+        return remaining
+
+    def close(self):
+        """Stop as soon as everything queued so far has been written."""
+        with self._condition:
+            self._closing = True
+            self._condition.notifyAll()
+
+    def shutdown(self):
+        dispatcher.Thread.shutdown(self)
+        with self._condition:
+            self._condition.notifyAll()
+
+    def run_thread(self):
+        try:
+            self._write_queued()
+        finally:
+            with self._condition:
+                self._stopped = True
+                self._condition.notifyAll()
+
+    def _write_queued(self):
+        while True:
+            with self._condition:
+                while not self.queue and not self._closing and not self._shutdown:
+                    self._condition.wait()
+                while self.queue:
+                    remaining = self._hold()
+                    if remaining is None:
+                        break
+                    self._condition.wait(remaining)
+                if not self.queue or self._shutdown:
+                    return
+                texts = self.queue
+                self.queue = []
+                self._flushing = False
+            try:
+                self.subject.write_encoded(texts)
+            except Exception, e:
+                with self._condition:
+                    self.error = e
+                    self._condition.notifyAll()
+                return
+            with self._condition:
+                self.queued -= sum(map(len, texts))
+                self._condition.notifyAll()
 
 class ClientConnection(dispatcher.Connection):
     """A connection manager for a connected socket (or similar) that
-    reads and dispatches JSON values."""
+    reads and dispatches JSON values.
+
+    Values are read and written with a codec (see the codec module),
+    given as the codec keyword argument or set as the codec attribute
+    of the class, or of any of its parents (see find_codec()).
+
+    If defer_decoding is set (as a keyword argument or class
+    attribute) and the codec uses a framer, the reading thread only
+    splits the input into the texts of the messages, and these are
+    dispatched undecoded. The dispatched handler then decodes them
+    with decode().
+
+    Messages sent with send() are encoded in the calling thread,
+    outside of any lock. If threaded_send is set (as a keyword
+    argument or class attribute), they are then queued for a Sender
+    thread, otherwise they are written directly while holding a
+    lock.
+
+    Setting coalesce_window (and optionally coalesce_count) the same
+    way implies threaded_send, and makes the Sender hold messages back
+    to write more of them at once; see Sender. Use flush() to have
+    the messages queued so far written right away.
+
+    The messages and bytes read and written, and the connections
+    opened and closed, are counted in a metrics.Metrics registry, if
+    one is given as the metrics keyword argument or class attribute,
+    or set on a parent. They are labelled with metrics_label (given
+    the same way), which defaults to the name of the connection, so
+    that connections with the same name share their counters. A
+    profile_hook
+    (see the profiling module) can be given the same way; the trace
+    of each message read is then handed to its dispatcher as the
+    trace keyword argument."""
+
+    codec = None
+    defer_decoding = False
+    threaded_send = False
+    coalesce_window = 0
+    coalesce_count = 0
+    metrics = None
+    metrics_label = None
+    profile_hook = None
+    Sender = Sender
+
+    # The trace of the message being dispatched by the reading thread
+    _read_trace = None
 
     def _init(self, subject, parent=None, *arg, **kw):
-        self.reader = json.Reader(subject)
-        self.writer = json.Writer(subject)
+        if 'codec' in kw:
+            self.codec = kw.pop('codec')
+        if 'defer_decoding' in kw:
+            self.defer_decoding = kw.pop('defer_decoding')
+        if 'threaded_send' in kw:
+            self.threaded_send = kw.pop('threaded_send')
+        for name in ('coalesce_window', 'coalesce_count', 'metrics', 'metrics_label', 'profile_hook'):
+            if name in kw:
+                setattr(self, name, kw.pop(name))
+        if self.codec is None:
+            self.codec = find_codec(parent)
+        if self.metrics is None:
+            self.metrics = find_inherited(parent, 'metrics')
+        if self.profile_hook is None:
+            self.profile_hook = find_inherited(parent, 'profile_hook')
+        self.reader = self.codec.reader(subject)
+        self.writer = self.codec.writer(subject)
+        self.deferred_decoding = self.defer_decoding and hasattr(self.reader, 'read_texts')
+        self._send_lock = threading.Lock()
+        self._sender = None
         dispatcher.Connection._init(self, subject=subject, parent=parent, *arg, **kw)
+        if self.metrics_label is None:
+            self.metrics_label = self.getName()
+        if self.metrics is not None:
+            self.metrics.count('connection_opened', self.metrics_label)
+        if self.threaded_send or self.coalesce_window:
+            self._sender = self.Sender(self.writer, parent=self,
+                                       coalesce_window=self.coalesce_window,
+                                       coalesce_count=self.coalesce_count)
+
+    def _exit(self):
+        # Let any outstanding dispatchers send their replies before
+        # the sender is stopped.
+        for child in list(self.children):
+            if child is not self._sender:
+                child.join()
+        if self._sender is not None:
+            self._sender.close()
+        if self.metrics is not None:
+            self.metrics.count('connection_closed', self.metrics_label)
+        dispatcher.Connection._exit(self)
+
+    def send(self, value, trace=None):
+        """Encodes and sends a value. If trace is given, the stages
+        of sending are added to it instead of to a trace of their
+        own."""
+        if self.profile_hook is not None:
+            self._send_traced(value, trace)
+            return
+        text = self.writer.encode(value)
+        self._count_sent(text)
+        if self._sender is not None:
+            self._sender.put(text)
+        else:
+            with self._send_lock:
+                self.writer.write_encoded([text])
+
+    def _count_sent(self, text):
+        if self.metrics is not None:
+            self.metrics.count('connection_messages_out', self.metrics_label)
+            self.metrics.count('connection_bytes_out', self.metrics_label, len(text))
+
+    def _send_traced(self, value, trace):
+        hook = self.profile_hook
+        own = trace is None
+        if own:
+            trace = hook.begin(self, "out")
+        start = time.time()
+        text = self.writer.encode(value)
+        self._count_sent(text)
+        encoded = time.time()
+        if self._sender is not None:
+            self._sender.put(text)
+            written = time.time()
+            if trace is not None:
+                hook.stage(trace, "serialize", start, encoded)
+                hook.stage(trace, "enqueue", encoded, written)
+        else:
+            with self._send_lock:
+                locked = time.time()
+                self.writer.write_encoded([text])
+            written = time.time()
+            if trace is not None:
+                hook.stage(trace, "serialize", start, encoded)
+                hook.stage(trace, "lock", encoded, locked)
+                hook.stage(trace, "write", locked, written)
+        if own and trace is not None:
+            hook.end(trace)
+
+    def flush(self):
+        """Writes any messages held back by the sender thread right
+        away."""
+        if self._sender is not None:
+            self._sender.flush()
+
+    def send_queue_size(self):
+        """Returns the number of bytes queued for the sender thread."""
+        if self._sender is None:
+            return 0
+        return self._sender.queued
 
     def shutdown(self):
         self.reader.close()
         self.writer.close()
         dispatcher.Connection.shutdown(self)
 
+    def run_thread(self):
+        try:
+            dispatcher.Connection.run_thread(self)
+        except framing.FramingError:
+            # Where the next message starts is unknown, so the
+            # connection is dropped.
+            traceback.print_exc()
+            self.shutdown()
+
     def read(self):
-        return self.reader.read_values()
+        if self.deferred_decoding:
+            values = self.reader.read_texts()
+        else:
+            values = self.reader.read_values()
+        if self.metrics is not None:
+            values = self._count_read(values)
+        if self.profile_hook is not None:
+            values = self._trace_read(values)
+        return values
+
+    def _trace_read(self, values):
+        hook = self.profile_hook
+        closable = getattr(self.reader, 'closable', None)
+        if closable is not None:
+            closable.timed = True
+        values = iter(values)
+        while True:
+            start = time.time()
+            if closable is not None:
+                waited = closable.wait_time
+            try:
+                value = values.next()
+            except StopIteration:
+                return
+            end = time.time()
+            if closable is not None:
+                # Don't count waiting for data as parsing.
+                start = min(end, start + closable.wait_time - waited)
+            self._read_trace = trace = hook.begin(self, "in")
+            if trace is not None:
+                hook.stage(trace, "parse", start, end)
+            yield value
+            self._read_trace = None
+
+    def _count_read(self, values):
+        # The underlying ReaderWrapper counts the bytes read.
+        closable = getattr(self.reader, 'closable', None)
+        bytes_read = 0
+        for value in values:
+            self.metrics.count('connection_messages_in', self.metrics_label)
+            if closable is not None:
+                self.metrics.count('connection_bytes_in', self.metrics_label, closable.bytes_read - bytes_read)
+                bytes_read = closable.bytes_read
+            yield value
+
+    def decode(self, subject):
+        """Returns subject, as dispatched by this connection,
+        decoded."""
+        if self.deferred_decoding:
+            return self.codec.decode(subject)
+        return subject
+
+class RPCError(Exception):
+    """Raised for a request answered with an error. The error
+    member of the response is available as the error attribute."""
+
+    def __init__(self, error):
+        if isinstance(error, dict) and 'message' in error:
+            message = error['message']
+        else:
+            message = error
+        Exception.__init__(self, message)
+        self.error = error
+
+class RequestTimeout(futures.TimeoutError):
+    """Raised for a request that is not answered before its
+    deadline."""
+
+class LateResponses(object):
+    """The ids of requests that have expired or been abandoned, so
+    that their responses can be dropped when they arrive. The ids are
+    kept in two generations, rotated every window seconds, so each
+    is remembered for at least that long and the table does not grow
+    without bound."""
+
+    def __init__(self, window=60.0):
+        self.window = window
+        self._current = {}
+        self._previous = {}
+        self._rotated = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, request_id, method):
+        with self._lock:
+            now = time.time()
+            if now - self._rotated >= self.window:
+                self._previous, self._current = self._current, {}
+                self._rotated = now
+            self._current[request_id] = method
+
+    def pop(self, request_id):
+        """Forgets request_id and returns the method of its request,
+        or returns None if it was not remembered."""
+        with self._lock:
+            for late in (self._current, self._previous):
+                if request_id in late:
+                    return late.pop(request_id)
+        return None
+
+def exception_error(e):
+    """Returns the error member of a response for the exception e."""
+    return {'type': type(e).__name__,
+            'args': list(e.args)}
+
+def complete_future(future, response):
+    """Completes future with the result of response, or with an
+    RPCError if it is an error response."""
+    if response.get('error') is not None:
+        future.set_exception(RPCError(response['error']))
+    else:
+        future.set_result(response.get('result'))
 
 class RPCClient(ClientConnection):
     """A JSON RPC client connection manager.
@@ -63,84 +465,537 @@ class RPCClient(ClientConnection):
 
     The dispatched threads are instances of RPCClient.Dispatch, and
     you must subclass it and override the dispatch_* methods in it to
-    handle incoming data."""
+    handle incoming data. Responses to requests that are waited for
+    are not dispatched, but handled directly by the reading thread.
+
+    Alternatively, a methods.MethodRegistry can be given as the
+    methods keyword argument or class attribute, or set on a parent
+    (such as an RPCServer), and the default dispatch_request() and
+    dispatch_notification() call the registered methods. Methods
+    registered as inline are run by the reading thread.
+
+    If there is a metrics.Metrics registry (see ClientConnection),
+    the requests made and handled are recorded in it. Requests
+    handled are labelled with their method names only if the methods
+    are registered, see metrics_method_label(). If metrics_method is
+    set (such as to "rpc.metrics", as a keyword argument or class
+    attribute, or on a parent), the remote side can read the registry
+    by calling that method, or the method with ".text" appended.
+
+    Requests are given a deadline of request_timeout seconds (a
+    keyword argument or class attribute, or set on a parent) unless
+    they are given a timeout of their own. The deadlines are all kept
+    by one timers.TimerWheel, the timer_wheel given the same way or
+    timers.default_wheel(). When a request expires, its future is
+    failed with RequestTimeout, and if it was sent by request()
+    without waiting for the response, request_expired() is called.
+    Requests sent that way without a deadline are not kept track of.
+    Responses that arrive after their request has expired or been
+    abandoned are dropped by the reading thread. pending_requests()
+    returns the number of requests waiting for their responses."""
 
     class Request(dispatcher.ThreadedClient):
+        trace = None
+
+        def _init(self, subject, parent=None, *arg, **kw):
+            if 'trace' in kw:
+                self.trace = kw.pop('trace')
+                self._dispatched = time.time()
+            dispatcher.ThreadedClient._init(self, subject=subject, parent=parent, *arg, **kw)
+
         def dispatch(self, subject):
+            if self.parent.profile_hook is not None:
+                self.dispatch_traced(subject)
+                return
+            subject = self.parent.decode(subject)
+            if isinstance(subject, list):
+                responses = [response for response in self.dispatch_batch(subject)
+                             if response is not None]
+                if responses:
+                    self.parent.send(responses)
+                return
+            answer = self._handle(subject)
+            if answer is not None:
+                self.parent.respond(*answer)
+
+        def dispatch_traced(self, subject):
+            hook = self.parent.profile_hook
+            if self.trace is None:
+                subject = self.parent.decode(subject)
+            else:
+                start = time.time()
+                hook.stage(self.trace, "dispatch", self._dispatched, start)
+                subject = self.parent.decode(subject)
+                if self.parent.deferred_decoding:
+                    hook.stage(self.trace, "parse", start, time.time())
+            try:
+                if isinstance(subject, list):
+                    response = [response for response in self.dispatch_batch(subject)
+                                if response is not None]
+                    if response:
+                        self.parent.send(response, self.trace)
+                else:
+                    answer = self._handle(subject)
+                    if answer is not None:
+                        self.parent.respond(*answer, trace=self.trace)
+            finally:
+                if self.trace is not None:
+                    hook.end(self.trace)
+
+        def handle(self, subject):
+            """Handles a single message, and returns the response to
+            send for it, if any."""
+            answer = self._handle(subject)
+            if answer is not None:
+                return self.parent.response(*answer)
+
+        def _handle(self, subject):
+            # Returns the result, error and id to respond with, if any.
+            if not isinstance(subject, dict):
+                return None, exception_error(ValueError("Invalid request", subject)), None
             if 'method' in subject and 'id' in subject:
+                dispatch_request = self.dispatch_request
+                if self.parent.metrics is not None and self.parent.is_metrics_method(subject['method']):
+                    dispatch_request = self.dispatch_metrics
                 try:
-                    result = self.dispatch_request(subject)
+                    result = self.call(dispatch_request, subject)
                     error = None
                 except Exception, e:
                     result = None
-                    error = {'type': type(e).__name__,
-                             'args': list(e.args)}
-                self.parent.respond(result, error, subject['id'])
+                    error = exception_error(e)
+                return result, error, subject['id']
             elif 'result' in subject or 'error' in subject:
-                assert 'id' in subject
-                if subject['id'] in self.parent._recv_waiting:
-                    with self.parent._recv_waiting[subject['id']]['condition']:
-                        self.parent._recv_waiting[subject['id']]['result'] = subject
-                        self.parent._recv_waiting[subject['id']]['condition'].notifyAll()
-                else:
+                if not self.parent.complete_response(subject):
                     self.dispatch_response(subject)
             elif 'method' in subject:
                 try:
-                    self.dispatch_notification(subject)
+                    self.call(self.dispatch_notification, subject)
                 except:
                     traceback.print_exc()
 
+        def call(self, dispatch, subject):
+            """Returns dispatch(subject), recording its latency and
+            outcome in the metrics of the connection, if any."""
+            metrics = self.parent.metrics
+            trace = self.trace
+            if metrics is None and trace is None:
+                return dispatch(subject)
+            if metrics is not None:
+                label = self.parent.metrics_method_label(subject['method'])
+                metrics.count('server_calls', label)
+            started = time.time()
+            try:
+                return dispatch(subject)
+            except:
+                if metrics is not None:
+                    metrics.count('server_errors', label)
+                raise
+            finally:
+                ended = time.time()
+                if trace is not None:
+                    self.parent.profile_hook.stage(trace, "handler", started, ended)
+                if metrics is not None:
+                    metrics.observe('server_latency_seconds', label, ended - started)
+                    metrics.count('server_completed', label)
+
+        def dispatch_metrics(self, subject):
+            if subject['method'].endswith('.text'):
+                return self.parent.metrics.text()
+            return self.parent.metrics.snapshot()
+
+        def dispatch_batch(self, subjects):
+            """Handles the messages of a batch concurrently, using the
+            dispatch_executor of the connection if it has one and
+            threads otherwise, and returns the list of their
+            responses.
+
+            Any message not yet started by another thread is run by
+            this one instead of being waited for, and messages are
+            only queued for an executor with a try_submit() method
+            (such as a dispatcher.ThreadPool) if its queue has room,
+            so that batches can not deadlock a bounded executor."""
+            if not subjects:
+                return [self.parent.response(None, exception_error(ValueError("Empty batch")), None)]
+            responses = [None] * len(subjects)
+            done = [threading.Event() for subject in subjects]
+            claimed = set()
+            lock = threading.Lock()
+            def run(n):
+                with lock:
+                    if n in claimed:
+                        return
+                    claimed.add(n)
+                try:
+                    responses[n] = self.handle(subjects[n])
+                finally:
+                    done[n].set()
+            executor = self.parent.dispatch_executor
+            if executor is not None:
+                submit = getattr(executor, 'try_submit', executor.submit)
+            for n in xrange(1, len(subjects)):
+                if executor is not None:
+                    # Messages that do not fit in the queue are run
+                    # by the loop below.
+                    submit(run, n)
+                else:
+                    thread = threading.Thread(target=run, args=(n,), name="%s/%s" % (self.getName(), n))
+                    thread.setDaemon(True)
+                    thread.start()
+            for n in xrange(len(subjects)):
+                run(n)
+            for event in done:
+                event.wait()
+            return responses
+
         def dispatch_request(self, subject):
-            pass
+            if self.parent.methods is not None:
+                return self.parent.methods.call(self.parent, subject)
 
         def dispatch_notification(self, subject):
-            pass
+            if self.parent.methods is not None:
+                self.parent.methods.call(self.parent, subject)
 
         def dispatch_response(self, subject):
             """Note: Only used to results for calls that some other thread isn't waiting for"""
             pass
 
+    methods = None
+    metrics_method = None
+    request_timeout = None
+    _closed = False
+    timer_wheel = None
+
+    # The ids of requests that have expired or been abandoned are
+    # remembered for at least this many seconds, so that their
+    # responses can be dropped.
+    late_response_window = 60.0
+
     def _init(self, subject, parent=None, *arg, **kw):
-        self._request_id = 0
-        self._send_lock = threading.Lock()
+        self._request_ids = itertools.count(1)
         self._recv_waiting = {}
+        for name in ('methods', 'metrics_method', 'request_timeout', 'timer_wheel'):
+            if name in kw:
+                setattr(self, name, kw.pop(name))
+            if getattr(self, name) is None:
+                setattr(self, name, find_inherited(parent, name))
+        if self.timer_wheel is None:
+            self.timer_wheel = timers.default_wheel()
+        self._late = LateResponses(self.late_response_window)
         ClientConnection._init(self, subject=subject, parent=parent, *arg, **kw)
 
+    def run_thread(self):
+        error = None
+        try:
+            ClientConnection.run_thread(self)
+        except Exception, e:
+            error = e
+            raise
+        finally:
+            # Nothing will answer the requests still waiting once the
+            # connection is closed.
+            self._fail_pending(error or EOFError())
+
+    def _fail_pending(self, error):
+        # Requests prepared from here on fail in prepare_request().
+        self._closed = True
+        waiting, self._recv_waiting = self._recv_waiting, {}
+        for future in waiting.itervalues():
+            if future.timer is not None:
+                future.timer.cancel()
+            self._request_finished(future, True)
+            future.set_exception(error)
+
     def request(self, method, params=[], wait_for_response=False, timeout=None):
-        with self._send_lock:
-            self._request_id += 1
-            request_id = self._request_id
-            if wait_for_response:
-                self._recv_waiting[request_id] = {'condition': threading.Condition(), 'result': None}
-            self.writer.write_value({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': request_id})
-
-            if not wait_for_response:
+        """Sends a request with a deadline of timeout seconds, or
+        request_timeout. If wait_for_response is set, waits for and
+        returns its result, raising RPCError if the remote side
+        answers with an error and RequestTimeout (a
+        futures.TimeoutError) if there is no answer before the
+        deadline. Otherwise returns the id of the request and lets
+        dispatch_response() handle the response. Such a request is
+        only kept track of if it has a deadline, and then
+        request_expired() is called if there is no response before
+        it."""
+        if timeout is None:
+            timeout = self.request_timeout
+        if not wait_for_response:
+            if timeout is None:
+                if self._closed:
+                    raise EOFError()
+                request_id = self._request_ids.next()
+                self.send({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': request_id})
                 return request_id
+            future, message = self.prepare_request(method, params, timeout)
+            future.dispatch_response = True
+            try:
+                self.send(message)
+            except:
+                self.abandon(future)
+                raise
+            return future.request_id
 
+        future = self.request_async(method, params, timeout)
         try:
-            with self._recv_waiting[request_id]['condition']:
-                if self._recv_waiting[request_id]['result'] == None:
-                    self._recv_waiting[request_id]['condition'].wait(timeout)
-                if self._recv_waiting[request_id]['result'].has_key('error') and self._recv_waiting[request_id]['result']['error'] is not None:
-                    exc = Exception(self._recv_waiting[request_id]['result']['error']['message'])
-                    raise exc
-                return self._recv_waiting[request_id]['result']['result']
+            try:
+                return future.result(timeout)
+            except futures.TimeoutError:
+                if future.done():
+                    raise
+                # The deadline has passed before the timer wheel got
+                # to it; expire the request right here instead.
+                self.expire(future)
+                return future.result()
         finally:
-            del self._recv_waiting[request_id]
+            self.abandon(future)
+
+    def request_async(self, method, params=[], timeout=None):
+        """Sends a request and returns a futures.Future for its
+        result, failed with RequestTimeout after timeout seconds, or
+        request_timeout. Use futures.wait() or futures.as_completed()
+        to wait for many requests at once."""
+        future, message = self.prepare_request(method, params, timeout)
+        try:
+            self.send(message)
+        except:
+            self.abandon(future)
+            raise
+        return future
+
+    def prepare_request(self, method, params=[], timeout=None):
+        """Returns a futures.Future for the result of a request
+        that is about to be sent, and the request message. Raises
+        EOFError if the connection has been closed."""
+        if self._closed:
+            raise EOFError()
+        future = futures.Future()
+        future.request_id = self._request_ids.next()
+        future.method = method
+        future.dispatch_response = False
+        future.timer = None
+        if self.metrics is not None:
+            future.started = time.time()
+            self.metrics.count('client_calls', method)
+        self._recv_waiting[future.request_id] = future
+        if self._closed and self._take_request(future.request_id) is not None:
+            # Closed meanwhile, after the pending requests were failed
+            self._request_finished(future, True)
+            raise EOFError()
+        if timeout is None:
+            timeout = self.request_timeout
+        if timeout is not None:
+            try:
+                future.timer = self.timer_wheel.schedule(timeout, self.expire, future)
+            except:
+                if self._take_request(future.request_id) is not None:
+                    self._request_finished(future, True)
+                raise
+        return future, {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': future.request_id}
+
+    def _take_request(self, request_id):
+        """Removes the request request_id from the pending ones and
+        returns its future, or None if it is not pending."""
+        future = self._recv_waiting.pop(request_id, None)
+        if future is not None and future.timer is not None:
+            future.timer.cancel()
+        return future
+
+    def abandon(self, future):
+        """Stops waiting for the response to the request of
+        future, unless it has already arrived."""
+        if self._take_request(future.request_id) is not None:
+            self._request_finished(future, True)
+            self._remember_late(future)
+
+    def expire(self, future):
+        """Fails the request of future with RequestTimeout, unless
+        its response has already arrived. Called by the timer
+        wheel."""
+        if self._take_request(future.request_id) is None:
+            return
+        self._request_finished(future, True)
+        if self.metrics is not None:
+            self.metrics.count('client_timeouts', future.method)
+        self._remember_late(future)
+        future.set_exception(RequestTimeout("No response to %s request %s" % (future.method, future.request_id)))
+        if future.dispatch_response:
+            self.request_expired(future.request_id)
+
+    def request_expired(self, request_id):
+        """Called when a request sent by request() without waiting
+        for the response expires. Runs in the thread of the timer
+        wheel, and so must return quickly."""
+        pass
+
+    def _remember_late(self, future):
+        self._late.add(future.request_id, future.method)
+
+    def _drop_late(self, request_id):
+        """Returns True if request_id is that of a request that has
+        expired or been abandoned."""
+        method = self._late.pop(request_id)
+        if method is None:
+            return False
+        if self.metrics is not None:
+            self.metrics.count('client_late_responses', method)
+        return True
+
+    def pending_requests(self):
+        """Returns the number of requests waiting for their
+        responses."""
+        return len(self._recv_waiting)
 
-    def respond(self, result, error, id):
-        with self._send_lock:
-            self.writer.write_value({'result': result, 'error': error, 'id': id})
+    def _request_finished(self, future, error):
+        if self.metrics is not None and hasattr(future, 'started'):
+            if error:
+                self.metrics.count('client_errors', future.method)
+            self.metrics.observe('client_latency_seconds', future.method, time.time() - future.started)
+            self.metrics.count('client_completed', future.method)
+
+    def batch(self):
+        """Returns a Batch, collecting requests and notifications
+        to send together."""
+        return Batch(self)
+
+    def dispatch(self, subject):
+        # Responses that a request() or request_async() caller is
+        # waiting for are completed right here in the reading thread,
+        # as starting a dispatcher just for that would only add
+        # latency. Callbacks added to the futures run here too.
+        trace = self._read_trace
+        if trace is not None:
+            start = time.time()
+        if isinstance(subject, dict):
+            if ('result' in subject or 'error' in subject) and self.complete_response(subject):
+                if trace is not None:
+                    self._end_trace(trace, "complete", start)
+                return
+            if 'method' in subject and self.methods is not None and self.methods.is_inline(subject['method']):
+                if trace is not None:
+                    self.dispatch_inline(subject, trace=trace)
+                else:
+                    self.dispatch_inline(subject)
+                return
+        elif isinstance(subject, list) and subject:
+            subject = [item for item in subject
+                       if not (isinstance(item, dict)
+                               and ('result' in item or 'error' in item)
+                               and self.complete_response(item))]
+            if not subject:
+                if trace is not None:
+                    self._end_trace(trace, "complete", start)
+                return
+        if trace is not None:
+            ClientConnection.dispatch(self, subject, trace=trace)
+        else:
+            ClientConnection.dispatch(self, subject)
+
+    def _end_trace(self, trace, stage, start):
+        self.profile_hook.stage(trace, stage, start, time.time())
+        self.profile_hook.end(trace)
+
+    def complete_response(self, subject):
+        """Completes the future waiting for the response subject,
+        or drops it if its request has expired. Returns False if it
+        is to be dispatched instead, which it also is if it has no
+        valid id."""
+        request_id = subject.get('id')
+        if not isinstance(request_id, (basestring, int, long)):
+            return False
+        future = self._take_request(request_id)
+        if future is None:
+            return self._drop_late(request_id)
+        self._request_finished(future, subject.get('error') is not None)
+        if future.dispatch_response:
+            return False
+        complete_future(future, subject)
+        return True
+
+    def is_metrics_method(self, name):
+        return self.metrics_method is not None and name in (self.metrics_method, self.metrics_method + '.text')
+
+    def metrics_method_label(self, name):
+        """Returns the label to record metrics for calls to the
+        method name with. The names are chosen by the remote side, so
+        calls to methods missing from the method registry (all of
+        them, if there is none) share one label. Override this to
+        label methods dispatched some other way."""
+        if self.is_metrics_method(name) or (self.methods is not None and name in self.methods):
+            return name
+        return "<unknown>"
+
+    def response(self, result, error, id):
+        return {'result': result, 'error': error, 'id': id}
+
+    def respond(self, result, error, id, trace=None):
+        """Sends a response. Responses to single requests are sent
+        with this method, which is given the trace of the request as
+        the trace keyword argument if the connection has a
+        profile_hook."""
+        self.send(self.response(result, error, id), trace)
 
     def notify(self, method, params=[]):
-        with self._send_lock:
-            self.writer.write_value({'method': method, 'params': params})
+        self.send({'method': method, 'params': params})
 
     def __getattr__(self, name):
         def rpc_wrapper(*arg):
             return self.request(name, list(arg), wait_for_response=True)
         return rpc_wrapper
 
+class Batch(object):
+    """Requests and notifications to send as a single JSON-RPC
+    batch, with one write. Use as a context manager:
+
+        with client.batch() as batch:
+            a = batch.request("foo")
+            b = batch.request("bar", [1, 2])
+            batch.notify("baz")
+        print a.result(), b.result()
+
+    The batch is sent when the with block is left without an
+    exception, or when send() is called. Each response completes the
+    futures.Future returned by request() on its own."""
+
+    def __init__(self, client):
+        self.client = client
+        self.messages = []
+        self.futures = []
+
+    def request(self, method, params=[], timeout=None):
+        future, message = self.client.prepare_request(method, params, timeout)
+        self.messages.append(message)
+        self.futures.append(future)
+        return future
+
+    def notify(self, method, params=[]):
+        self.messages.append({'method': method, 'params': params})
+
+    def send(self):
+        messages, self.messages = self.messages, []
+        fs, self.futures = self.futures, []
+        if not messages:
+            return
+        try:
+            self.client.send(messages)
+        except:
+            self._abandon(fs)
+            raise
+
+    def _abandon(self, fs):
+        for future in fs:
+            self.client.abandon(future)
+            future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.send()
+        else:
+            self._abandon(self.futures)
+            self.messages = []
+            self.futures = []
+
 class RPCServer(dispatcher.ServerConnection):
     """A JSON RPC server connection manager. This class manages a
     listening sockets and recieves and dispatches new inbound
@@ -150,7 +1005,29 @@ class RPCServer(dispatcher.ServerConnection):
 
     RPCServer.Dispatch.Dispatch is an RPCClient subclass that handles
     incoming requests, responses and notifications. Initial calls to
-    the remote side can be done from its run_parent() method."""
+    the remote side can be done from its run_parent() method.
+
+    The codec used for inbound connections can be given as the codec
+    keyword argument or class attribute, see ClientConnection, and so
+    can the methods.MethodRegistry to serve, see RPCClient, the
+    metrics.Metrics registry to record to, the metrics_method to serve
+    it as, the profile_hook to use, and the request_timeout and
+    timer_wheel of requests made over the inbound connections."""
+
+    codec = None
+    methods = None
+    metrics = None
+    metrics_method = None
+    profile_hook = None
+    request_timeout = None
+    timer_wheel = None
+
+    def _init(self, subject, parent=None, *arg, **kw):
+        for name in ('codec', 'methods', 'metrics', 'metrics_method', 'profile_hook', 'request_timeout',
+                     'timer_wheel'):
+            if name in kw:
+                setattr(self, name, kw.pop(name))
+        dispatcher.ServerConnection._init(self, subject=subject, parent=parent, *arg, **kw)
 
     class InboundConnection(dispatcher.ThreadedClient):
         class Thread(RPCClient):
@@ -311,6 +1188,453 @@ class TestRpc(unittest.TestCase):
             server.shutdown()
             server.join()
 
+    def test_rpc_codecs(self):
+        for server_codec, client_codec in ((codec.StdlibCodec(), codec.StdlibCodec()),
+                                           (codec.StdlibCodec(), None),
+                                           (None, codec.StdlibCodec())):
+            server_socket = test_make_server_socket()
+            server = TestPongRPCServer(server_socket, name="PongServer", codec=server_codec)
+
+            client_socket = test_make_client_socket()
+            client = TestPingRPCClient(client_socket, codec=client_codec)
+            self.assertEqual(client.ping(), "pong")
+            server.shutdown()
+            server.join()
+
+    def test_rpc_framing(self):
+        for framer_class in (framing.LineFramer, framing.LengthPrefixFramer):
+            for defer_decoding in (False, True):
+                server_socket = test_make_server_socket()
+                server = TestPongRPCServer(server_socket, name="PongServer",
+                                           codec=codec.StdlibCodec(framer_class=framer_class))
+
+                client_socket = test_make_client_socket()
+                client = TestPingRPCClient(client_socket, defer_decoding=defer_decoding,
+                                           codec=codec.PythonCodec(framer_class=framer_class))
+                self.assertEqual(client.deferred_decoding, defer_decoding)
+                self.assertEqual(client.ping(), "pong")
+                server.shutdown()
+                server.join()
+
+    def test_rpc_framing_error(self):
+        sockets = socket.socketpair()
+        client = RPCClient(sockets[0], codec=codec.PythonCodec(framer_class=framing.LengthPrefixFramer))
+        future = client.request_async("ping")
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            sockets[1].sendall('\xff\xff\xff\xff')
+            client.join(5)
+        finally:
+            stderr, sys.stderr = sys.stderr, stderr
+        self.assertFalse(client.isAlive())
+        self.assertTrue("FramingError" in stderr.getvalue())
+        self.assertRaises(EOFError, lambda: future.result(5))
+        sockets[1].settimeout(5)
+        data = sockets[1].recv(4096)
+        while data:
+            data = sockets[1].recv(4096)
+        sockets[1].close()
+
+    def test_rpc_threaded_send(self):
+        server_socket = test_make_server_socket()
+        server = TestPongRPCServer(server_socket, name="PongServer")
+
+        client_socket = test_make_client_socket()
+        client = TestPingRPCClient(client_socket, threaded_send=True)
+        results = []
+        def ping():
+            results.append(client.ping())
+        threads = [threading.Thread(target=ping) for n in xrange(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["pong"] * 20)
+        self.assertEqual(client.send_queue_size(), 0)
+        client.shutdown()
+        server.shutdown()
+        server.join()
+
+    def test_rpc_sender_closed(self):
+        sockets = socket.socketpair()
+        sender = Sender(codec.PythonCodec().writer(sockets[0]))
+        sender.put('[1]')
+        sender.close()
+        self.assertRaises(EOFError, lambda: sender.put('[2]'))
+        sender.join(5)
+        self.assertFalse(sender.isAlive())
+        self.assertRaises(EOFError, lambda: sender.put('[3]'))
+        self.assertEqual(json.Reader(sockets[1]).read_value(), [1])
+        sockets[0].close()
+        sockets[1].close()
+
+    def test_rpc_coalesce(self):
+        sockets = socket.socketpair()
+        client = RPCClient(sockets[0], coalesce_window=10, coalesce_count=3)
+        sockets[1].settimeout(0.1)
+        reader = json.Reader(sockets[1])
+        client.notify("a")
+        client.notify("b")
+        self.assertRaises(socket.timeout, lambda: sockets[1].recv(1, socket.MSG_PEEK))
+        client.notify("c")
+        self.assertEqual([reader.read_value()['method'] for n in xrange(3)], ["a", "b", "c"])
+        client.notify("d")
+        self.assertRaises(socket.timeout, lambda: sockets[1].recv(1, socket.MSG_PEEK))
+        client.flush()
+        self.assertEqual(reader.read_value()['method'], "d")
+        client.shutdown()
+        sockets[1].close()
+
+    def test_rpc_async(self):
+        server_socket = test_make_server_socket()
+        server = TestPongRPCServer(server_socket, name="PongServer")
+
+        client_socket = test_make_client_socket()
+        client = TestPingRPCClient(client_socket)
+        fs = [client.request_async("ping") for n in xrange(50)]
+        self.assertEqual([f.result() for f in futures.as_completed(fs)], ["pong"] * 50)
+        self.assertEqual(futures.wait(fs, timeout=1), (set(fs), set()))
+        self.assertEqual(client._recv_waiting, {})
+
+        error = client.request_async("foo")
+        self.assertRaises(RPCError, error.result)
+        self.assertEqual(error.exception().error['type'], 'AssertionError')
+        client.shutdown()
+        server.shutdown()
+        server.join()
+
+    def test_rpc_inline_response(self):
+        sockets = socket.socketpair()
+        client = RPCClient(sockets[0])
+        future = client.request_async("ping")
+        threads = []
+        future.add_done_callback(lambda f: threads.append(threading.currentThread()))
+        sockets[1].sendall('{"result": "pong", "error": null, "id": %s}' % future.request_id)
+        self.assertEqual(future.result(5), "pong")
+        self.assertEqual(threads, [client])
+
+        # Responses without a valid id must not kill the reader
+        sockets[1].sendall('{"result": 1, "error": null} {"result": 1, "error": null, "id": [1]}')
+        future = client.request_async("ping")
+        sockets[1].sendall('{"result": "pong", "error": null, "id": %s}' % future.request_id)
+        self.assertEqual(future.result(5), "pong")
+        client.shutdown()
+        sockets[1].close()
+
+    def test_rpc_respond(self):
+        class Client(TestPingRPCClient):
+            def respond(self, result, error, id, trace=None):
+                TestPingRPCClient.respond(self, [result], error, id, trace)
+        sockets = socket.socketpair()
+        client = Client(sockets[0])
+        sockets[1].sendall('{"method": "pingping", "params": [], "id": 1}')
+        self.assertEqual(json.Reader(sockets[1]).read_value()['result'], ["pingpong"])
+        client.shutdown()
+        sockets[1].close()
+
+    def test_rpc_batch(self):
+        server_socket = test_make_server_socket()
+        server = TestPongRPCServer(server_socket, name="PongServer")
+
+        client_socket = test_make_client_socket()
+        client = TestPingRPCClient(client_socket)
+        with client.batch() as batch:
+            pings = [batch.request("ping") for n in xrange(5)]
+            error = batch.request("foo")
+            batch.notify("ping")
+        self.assertEqual([f.result(5) for f in pings], ["pong"] * 5)
+        self.assertRaises(RPCError, lambda: error.result(5))
+        client.shutdown()
+        server.shutdown()
+        server.join()
+
+    def test_rpc_batch_response(self):
+        sockets = socket.socketpair()
+        server = TestPingRPCClient(sockets[0])
+        reader = json.Reader(sockets[1])
+        writer = json.Writer(sockets[1])
+        writer.write_value([{'method': 'pingping', 'params': [], 'id': 1},
+                            {'method': 'pingping', 'params': []},
+                            {'method': 'pingping', 'params': [], 'id': 2},
+                            17])
+        responses = reader.read_value()
+        self.assertEqual(responses[:2],
+                         [{'result': 'pingpong', 'error': None, 'id': 1},
+                          {'result': 'pingpong', 'error': None, 'id': 2}])
+        self.assertEqual(responses[2]['id'], None)
+        self.assertEqual(responses[2]['error']['type'], 'ValueError')
+        writer.write_value([])
+        self.assertEqual(len(reader.read_value()), 1)
+        server.shutdown()
+        sockets[1].close()
+
+    def test_rpc_batch_pool(self):
+        # The batch is handled by the only worker, and its messages
+        # must not wait for room in the queue.
+        sockets = socket.socketpair()
+        pool = dispatcher.ThreadPool(max_workers=1, max_queue=1)
+        server = TestPingRPCClient(sockets[0], dispatch_executor=pool)
+        reader = json.Reader(sockets[1])
+        writer = json.Writer(sockets[1])
+        writer.write_value([{'method': 'pingping', 'params': [], 'id': n} for n in xrange(5)])
+        sockets[1].settimeout(5)
+        self.assertEqual(sorted(response['id'] for response in reader.read_value()), range(5))
+        server.shutdown()
+        sockets[1].close()
+        server.join()
+        pool.shutdown()
+
+    def test_rpc_timeout(self):
+        sockets = socket.socketpair()
+        client = RPCClient(sockets[0])
+        self.assertRaises(futures.TimeoutError,
+                          lambda: client.request("ping", wait_for_response=True, timeout=0.1))
+        self.assertEqual(client._recv_waiting, {})
+
+        # The timeout holds even when the timer wheel is late
+        wheel = timers.TimerWheel()
+        wheel.schedule(0, time.sleep, 1)
+        client.timer_wheel = wheel
+        start = time.time()
+        self.assertRaises(RequestTimeout,
+                          lambda: client.request("ping", wait_for_response=True, timeout=0.1))
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertEqual(client._recv_waiting, {})
+        wheel.stop()
+        self.assertRaises(RuntimeError, lambda: client.request_async("ping", timeout=1))
+        self.assertEqual(client._recv_waiting, {})
+        client.shutdown()
+        sockets[1].close()
+
+    def test_rpc_deadlines(self):
+        sockets = socket.socketpair()
+        expired = []
+        class Client(RPCClient):
+            def request_expired(self, request_id):
+                expired.append(request_id)
+        wheel = timers.TimerWheel(tick=0.01)
+        client = Client(sockets[0], request_timeout=0.05, timer_wheel=wheel, metrics=metrics.Metrics())
+        reader = json.Reader(sockets[1])
+        writer = json.Writer(sockets[1])
+
+        future = client.request_async("ping")
+        request_id = client.request("ping")
+        slow = client.request_async("ping", timeout=10)
+        self.assertEqual(client.pending_requests(), 3)
+        client.request_timeout = None
+        untracked = client.request("ping")
+        self.assertEqual(client.pending_requests(), 3)
+        self.assertRaises(RequestTimeout, lambda: future.result(5))
+        for n in xrange(100):
+            if expired:
+                break
+            time.sleep(0.01)
+        self.assertEqual(expired, [request_id])
+        self.assertEqual(client.pending_requests(), 1)
+        self.assertEqual(len(wheel), 1)
+
+        for n in xrange(4):
+            request = reader.read_value()
+            if request['id'] != untracked:
+                writer.write_value({'result': 'pong', 'error': None, 'id': request['id']})
+        self.assertEqual(slow.result(5), "pong")
+        self.assertEqual(len(wheel), 0)
+        counters = client.metrics.snapshot()['counters']
+        self.assertEqual(counters['client_timeouts'], {'ping': 2})
+        self.assertEqual(counters['client_late_responses'], {'ping': 2})
+        client.shutdown()
+        sockets[1].close()
+        wheel.stop()
+
+    def test_rpc_closed(self):
+        sockets = socket.socketpair()
+        client = RPCClient(sockets[0])
+        future = client.request_async("ping")
+        json.Reader(sockets[1]).read_value()
+        sockets[1].close()
+        self.assertRaises(EOFError, lambda: future.result(5))
+        client.join()
+        self.assertEqual(client._recv_waiting, {})
+        self.assertRaises(EOFError, lambda: client.request_async("ping"))
+        self.assertEqual(client._recv_waiting, {})
+
+    def test_rpc_dispatch_pool(self):
+        server_socket = test_make_server_socket()
+        server = TestPongRPCServer(server_socket, name="PongServer")
+
+        client_socket = test_make_client_socket()
+        pool = dispatcher.ThreadPool(max_workers=2, max_queue=4)
+        client = TestPingRPCClient(client_socket, dispatch_executor=pool)
+        fs = [client.request_async("ping") for n in xrange(20)]
+        self.assertEqual([f.result(5) for f in fs], ["pong"] * 20)
+        self.assertEqual(len(pool.workers), 2)
+        client.shutdown()
+        client.join()
+        pool.shutdown()
+        server.shutdown()
+        server.join()
+
+    def test_rpc_server_dispatch_pool(self):
+        server_socket = test_make_server_socket()
+        pool = dispatcher.ThreadPool(max_workers=1)
+        server = TestPongRPCServer(server_socket, name="PongServer", dispatch_executor=pool)
+
+        # Each inbound connection has threads of its own, so a single
+        # worker serves the requests of both clients.
+        clients = [TestPingRPCClient(test_make_client_socket()) for n in xrange(2)]
+        fs = [client.request_async("ping") for client in clients for n in xrange(5)]
+        self.assertEqual([f.result(5) for f in fs], ["pong"] * 10)
+        self.assertEqual(len(pool.workers), 1)
+        for client in clients:
+            client.shutdown()
+            client.join()
+        server.shutdown()
+        server.join()
+        pool.shutdown()
+
+    def test_dispatch_queued(self):
+        class Executor(object):
+            def __init__(self):
+                self.calls = []
+            def submit(self, fn, *arg, **kw):
+                self.calls.append((fn, arg, kw))
+        executor = Executor()
+        sockets = socket.socketpair()
+        client = TestPingRPCClient(sockets[0], dispatch_executor=executor)
+        children = len(client.children)
+        client.dispatch({'id': 1, 'method': "pingping", 'params': []})
+        # Queued dispatchers are joined by the connection.
+        self.assertEqual(len(executor.calls), 1)
+        self.assertEqual(len(client.children), children + 1)
+        fn, arg, kw = executor.calls[0]
+        fn(*arg, **kw)
+        self.assertEqual(len(client.children), children)
+        self.assertEqual(json.Reader(sockets[1]).read_value()['result'], "pingpong")
+        sockets[1].close()
+        client.join()
+
+    def test_rpc_methods(self):
+        registry = methods.MethodRegistry()
+        registry.register("add", lambda a, b=0: a + b)
+        @registry.register(pass_connection=True)
+        def ping(connection):
+            return connection.request("pingping", wait_for_response=True) == "pingpong" and "pong"
+        @registry.register(inline=True)
+        def thread():
+            return threading.currentThread().getName()
+
+        server_socket = test_make_server_socket()
+        server = RPCServer(server_socket, name="MethodServer", methods=registry)
+
+        client_socket = test_make_client_socket()
+        client = TestPingRPCClient(client_socket)
+        self.assertEqual(client.add(1, 2), 3)
+        self.assertEqual(client.request("add", {'a': 1, 'b': 3}, wait_for_response=True), 4)
+        self.assertEqual(client.ping(), "pong")
+        self.assertEqual(client.thread(), "MethodServer/InboundConnection/Thread")
+        self.assertRaises(RPCError, lambda: client.mul(1, 2))
+        for method, error_type in (("add", 'InvalidParams'), ("mul", 'MethodNotFound')):
+            try:
+                client.request(method, wait_for_response=True)
+            except RPCError, e:
+                self.assertEqual(e.error['type'], error_type)
+            else:
+                self.fail("%s() did not fail" % method)
+        client.shutdown()
+        server.shutdown()
+        server.join()
+
+    def test_rpc_metrics(self):
+        registry = methods.MethodRegistry()
+        registry.register("add", lambda a, b: a + b)
+        server_metrics = metrics.Metrics()
+        client_metrics = metrics.Metrics()
+
+        server_socket = test_make_server_socket()
+        server = RPCServer(server_socket, name="MetricsServer", methods=registry, metrics=server_metrics,
+                           metrics_method="rpc.metrics")
+
+        client_socket = test_make_client_socket()
+        client = RPCClient(client_socket, metrics=client_metrics)
+        self.assertEqual(client.add(1, 2), 3)
+        self.assertEqual(client.add(3, 4), 7)
+        self.assertRaises(RPCError, lambda: client.add(1))
+        self.assertRaises(RPCError, lambda: client.mul(1, 2))
+
+        snapshot = client.request("rpc.metrics", wait_for_response=True)
+        self.assertEqual(snapshot['counters']['server_calls'], {'add': 3, '<unknown>': 1, 'rpc.metrics': 1})
+        self.assertEqual(snapshot['counters']['server_errors'], {'add': 1, '<unknown>': 1})
+        self.assertEqual(snapshot['gauges']['server_in_flight'], {'add': 0, '<unknown>': 0, 'rpc.metrics': 1})
+        self.assertEqual(snapshot['histograms']['server_latency_seconds']['add']['count'], 3)
+        self.assertTrue('symmetricjsonrpc_server_calls_total{method="add"} 3\n'
+                        in client.request("rpc.metrics.text", wait_for_response=True))
+
+        snapshot = client_metrics.snapshot()
+        self.assertEqual(snapshot['counters']['client_calls'],
+                         {'add': 3, 'mul': 1, 'rpc.metrics': 1, 'rpc.metrics.text': 1})
+        self.assertEqual(snapshot['counters']['client_errors'], {'add': 1, 'mul': 1})
+        self.assertEqual(snapshot['gauges']['client_in_flight']['add'], 0)
+        self.assertEqual(snapshot['counters']['connection_messages_out'][client.metrics_label], 6)
+        self.assertEqual(snapshot['counters']['connection_messages_in'][client.metrics_label], 6)
+        self.assertTrue(snapshot['counters']['connection_bytes_in'][client.metrics_label] > 0)
+        self.assertEqual(snapshot['gauges']['connection_open'], {"RPCClient": 1})
+        client.shutdown()
+        client.join()
+
+        # Connections with the same name share their counters.
+        client = RPCClient(test_make_client_socket(), metrics=client_metrics)
+        self.assertEqual(client.add(1, 2), 3)
+        client.shutdown()
+        client.join()
+        snapshot = client_metrics.snapshot()
+        self.assertEqual(snapshot['counters']['connection_opened'], {"RPCClient": 2})
+        self.assertEqual(snapshot['gauges']['connection_open'], {"RPCClient": 0})
+        self.assertEqual(snapshot['counters']['connection_messages_out'], {"RPCClient": 7})
+        server.shutdown()
+        server.join()
+        label = "MetricsServer/InboundConnection/Thread"
+        self.assertEqual(server_metrics.snapshot()['counters']['connection_opened'], {label: 2})
+
+        # Without a method registry, all methods share one label, and
+        # the metrics are only served if asked for.
+        server_metrics = metrics.Metrics()
+        server_socket = test_make_server_socket()
+        server = TestPongRPCServer(server_socket, name="MetricsServer", metrics=server_metrics)
+        client = TestPingRPCClient(test_make_client_socket())
+        self.assertEqual(client.ping(), "pong")
+        self.assertRaises(RPCError, lambda: client.request("rpc.metrics", wait_for_response=True))
+        self.assertEqual(server_metrics.snapshot()['counters']['server_calls'], {'<unknown>': 2})
+        client.shutdown()
+        server.shutdown()
+        server.join()
+
+    def test_rpc_profiling(self):
+        registry = methods.MethodRegistry()
+        registry.register("add", lambda a, b: a + b)
+        server_profiler = profiling.SamplingProfiler(rate=1.0)
+        client_profiler = profiling.SamplingProfiler(rate=1.0)
+
+        server_socket = test_make_server_socket()
+        server = RPCServer(server_socket, name="ProfiledServer", methods=registry, profile_hook=server_profiler)
+
+        client_socket = test_make_client_socket()
+        client = RPCClient(client_socket, profile_hook=client_profiler)
+        for n in xrange(3):
+            self.assertEqual(client.add(n, 1), n + 1)
+        client.shutdown()
+        client.join()
+        server.shutdown()
+        server.join()
+
+        def stages(profiler):
+            return sorted((kind, name, count) for kind, name, count, total, longest in profiler.breakdown())
+        self.assertEqual(stages(server_profiler),
+                         [("in", None, 3), ("in", "dispatch", 3), ("in", "handler", 3), ("in", "lock", 3),
+                          ("in", "parse", 3), ("in", "serialize", 3), ("in", "write", 3)])
+        self.assertEqual(stages(client_profiler),
+                         [("in", None, 3), ("in", "complete", 3), ("in", "parse", 3),
+                          ("out", None, 3), ("out", "lock", 3), ("out", "serialize", 3), ("out", "write", 3)])
+
     def test_rpc_p2p_server(self):
         for n in range(3):
             server_socket = test_make_server_socket()
@@ -0,0 +1,211 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+
+# python-symmetric-jsonrpc
+# Copyright (C) 2009 Egil Moeller <redhog@redhog.org>
+# Copyright (C) 2009 Nicklas Lindgren <nili@gulmohar.se>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""A hashed timer wheel, running any number of timers with a single
+thread."""
+
+from __future__ import with_statement
+
+import math
+import threading
+import time
+import traceback
+import unittest
+
+class Timer(object):
+    """A timer scheduled on a TimerWheel; see TimerWheel.schedule()."""
+
+    def __init__(self, wheel, deadline, tick, fn, arg, kw):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.tick = tick
+        self.fn = fn
+        self.arg = arg
+        self.kw = kw
+        self.cancelled = False
+
+    def cancel(self):
+        """Stops the timer from firing, unless it already has."""
+        self.wheel.cancel(self)
+
+class TimerWheel(object):
+    """Timers hashed by their deadline into slots buckets, each
+    covering tick seconds. A single thread wakes up every tick
+    seconds and fires the timers that are due in the current bucket,
+    so scheduling and cancelling a timer take constant time however
+    many there are, and timers fire up to tick seconds late.
+
+    The thread is started when the first timer is scheduled, and
+    sleeps while there are none. Timers should return quickly, as
+    they are all run by this thread."""
+
+    def __init__(self, tick=0.1, slots=512, name=None):
+        self.tick = tick
+        self.slots = [set() for n in xrange(slots)]
+        self.name = name or type(self).__name__
+        self.thread = None
+        self._count = 0
+        self._current = int(time.time() / tick)
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def schedule(self, delay, fn, *arg, **kw):
+        """Calls fn(*arg, **kw) from the thread of the wheel after
+        delay seconds, and returns a Timer that can be cancelled.
+        Raises RuntimeError if the wheel has been stopped."""
+        deadline = time.time() + delay
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("%s has been stopped" % self.name)
+            # Never put a timer in the bucket being fired, or in one
+            # that has already been passed.
+            tick = max(int(math.ceil(deadline / self.tick)), self._current + 1)
+            timer = Timer(self, deadline, tick, fn, arg, kw)
+            self.slots[tick % len(self.slots)].add(timer)
+            self._count += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name)
+                self.thread.setDaemon(True)
+                self.thread.start()
+            elif self._count == 1:
+                self._condition.notifyAll()
+        return timer
+
+    def cancel(self, timer):
+        with self._condition:
+            if not timer.cancelled:
+                timer.cancelled = True
+                slot = self.slots[timer.tick % len(self.slots)]
+                if timer in slot:
+                    slot.remove(timer)
+                    self._count -= 1
+
+    def __len__(self):
+        """Returns the number of timers scheduled."""
+        return self._count
+
+    def _due(self):
+        """Removes and returns the timers due up to now. Must be called
+        with the condition held."""
+        now = int(time.time() / self.tick)
+        due = []
+        # After a long sleep, every bucket needs to be visited at most
+        # once.
+        first = max(self._current + 1, now - len(self.slots) + 1)
+        for tick in xrange(first, now + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for timer in [timer for timer in slot if timer.tick <= now]:
+                slot.remove(timer)
+                timer.cancelled = True
+                due.append(timer)
+        self._current = max(self._current, now)
+        self._count -= len(due)
+        return due
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._count and not self._stopped:
+                    self._condition.wait()
+                    self._current = max(self._current, int(time.time() / self.tick) - 1)
+                if self._stopped:
+                    return
+                self._condition.wait((self._current + 1) * self.tick - time.time())
+                due = self._due()
+            for timer in due:
+                try:
+                    timer.fn(*timer.arg, **timer.kw)
+                except Exception:
+                    traceback.print_exc()
+
+    def stop(self):
+        """Stops the thread, dropping all timers."""
+        with self._condition:
+            self._stopped = True
+            for slot in self.slots:
+                slot.clear()
+            self._count = 0
+            self._condition.notifyAll()
+        if self.thread is not None:
+            self.thread.join()
+
+_default_wheel = None
+_default_lock = threading.Lock()
+
+def default_wheel():
+    """Returns the TimerWheel shared by everything that is not given
+    one of its own."""
+    global _default_wheel
+    with _default_lock:
+        if _default_wheel is None:
+            _default_wheel = TimerWheel(name="DefaultTimerWheel")
+        return _default_wheel
+
+
+#### Test code ####
+
+class TestTimers(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(tick=0.01, slots=8)
+
+    def tearDown(self):
+        self.wheel.stop()
+
+    def test_fire(self):
+        fired = []
+        done = threading.Event()
+        start = time.time()
+        self.wheel.schedule(0.05, fired.append, "a")
+        # Goes round the wheel more than once
+        self.wheel.schedule(0.2, lambda: (fired.append("b"), done.set()))
+        self.wheel.schedule(0.0, fired.append, "c")
+        cancelled = self.wheel.schedule(0.1, fired.append, "d")
+        self.assertEqual(len(self.wheel), 4)
+        cancelled.cancel()
+        self.assertEqual(len(self.wheel), 3)
+        done.wait(5)
+        self.assertEqual(fired, ["c", "a", "b"])
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_many(self):
+        fired = []
+        timers = [self.wheel.schedule(0.5 + 0.01 * (n % 16), fired.append, n) for n in xrange(10000)]
+        for timer in timers[::2]:
+            timer.cancel()
+        self.assertEqual(len(self.wheel), 5000)
+        for n in xrange(100):
+            if len(fired) == 5000:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(sorted(fired), range(1, 10000, 2))
+
+    def test_stop(self):
+        self.wheel.schedule(10, lambda: None)
+        self.wheel.stop()
+        self.assertEqual(len(self.wheel), 0)
+        self.assertRaises(RuntimeError, lambda: self.wheel.schedule(0, lambda: None))
+
+if __name__ == "__main__":
+    unittest.main()
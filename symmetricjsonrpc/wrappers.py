@@ -27,7 +27,11 @@ behind an identical interface."""
 debug_write = False
 debug_read = False
 
+import os
+import re
 import select
+import stat
+import time
 
 class WriterWrapper(object):
     """Provides a unified interface for writing to sockets or
@@ -37,6 +41,7 @@ class WriterWrapper(object):
     depending on what type of object it wraps."""
     poll_timeout = 1000
     buff_maxsize = 512
+    copy_threshold = 65536
 
     def __new__(cls, f):
         if cls is not WriterWrapper:
@@ -68,14 +73,43 @@ class WriterWrapper(object):
         if self.buff_len > self.buff_maxsize:
             self.flush()
 
+    def writelines(self, parts):
+        self.buff.extend(parts)
+        self.buff_len += sum(map(len, parts))
+        if self.buff_len > self.buff_maxsize:
+            self.flush()
+
     def flush(self):
-        data = ''.join(self.buff)
-        del self.buff[:]
+        parts = self.buff
+        self.buff = []
         self.buff_len = 0
-        if debug_write: print "write(%s)" % (repr(data),)
-        while data:
-            self._wait()
-            data = data[self._write(data):]
+        if debug_write: print "write(%s)" % (repr(''.join(parts)),)
+        for data in self._gather(parts):
+            # Continue after partial writes through a buffer object
+            # rather than by copying the rest of the data.
+            offset = 0
+            while offset < len(data):
+                self._wait()
+                if offset:
+                    offset += self._write(buffer(data, offset))
+                else:
+                    offset += self._write(data)
+
+    def _gather(self, parts):
+        """Joins runs of small strings in parts, but passes strings
+        of copy_threshold bytes or more on as they are, to avoid
+        copying large payloads."""
+        small = []
+        for part in parts:
+            if len(part) < self.copy_threshold:
+                small.append(part)
+            else:
+                if small:
+                    yield ''.join(small)
+                    small = []
+                yield part
+        if small:
+            yield ''.join(small)
 
     def _wait(self):
         if not self.poll:
@@ -103,22 +137,42 @@ class ReaderWrapper(object):
     """Provides a unified interface for reading from sockets or
     file-like objects.
 
+    Data is read from the underlying object in chunks of up to
+    read_size bytes into a buffer, and the poll for readability is
+    only done when that buffer has been consumed. Consumers can either
+    iterate over single characters, or take whole chunks of buffered
+    data at a time using read_chunk().
+
+    If timed is set, the time spent waiting for and reading data is
+    added up in wait_time.
+
     Its instances will actually belong to one of its subclasses,
     depending on what type of object it wraps."""
     poll_timeout = 1000
+    read_size = 65536
+    timed = False
 
-    def __new__(cls, f):
+    def __new__(cls, f, *arg, **kw):
         if cls is not ReaderWrapper:
             return object.__new__(cls)
         elif hasattr(f, "recv"):
-            return SocketReader(f)
+            return SocketReader(f, *arg, **kw)
         elif hasattr(f, "read"):
-            return FileReader(f)
+            return FileReader(f, *arg, **kw)
         else:
             return f
 
-    def __init__(self, f):
+    def __init__(self, f, read_size=None):
+        if f is self:
+            # An already wrapped object was passed to ReaderWrapper()
+            return
         self.file = f
+        if read_size is not None:
+            self.read_size = read_size
+        self.buff = ''
+        self.pos = 0
+        self.bytes_read = 0
+        self.wait_time = 0.0
         self.poll = None
         if hasattr(f, 'fileno'):
             self.poll = select.poll()
@@ -129,21 +183,46 @@ class ReaderWrapper(object):
         return self
 
     def next(self):
+        pos = self.pos
+        if pos >= len(self.buff):
+            self._fill()
+            pos = 0
+        self.pos = pos + 1
+        return self.buff[pos]
+
+    def read_chunk(self):
+        """Returns all buffered data not yet consumed, reading a new
+        chunk if the buffer is empty. Raises StopIteration on EOF."""
+        if self.pos >= len(self.buff):
+            self._fill()
+        result = self.buff
+        if self.pos:
+            result = result[self.pos:]
+        self.buff = ''
+        self.pos = 0
+        return result
+
+    def close(self):
+        self.closed = True
+        self.file.close()
+
+    def _fill(self):
+        if self.timed:
+            start = time.time()
         try:
             self._wait()
         except EOFError:
             raise StopIteration
-        result = self._read()
+        result = self._read(self.read_size)
+        if self.timed:
+            self.wait_time += time.time() - start
         if result == '':
             raise StopIteration
-        else:
-            if debug_read:
-                print "read(%s)" % (repr(result),)
-            return result
-
-    def close(self):
-        self.closed = True
-        self.file.close()
+        if debug_read:
+            print "read(%s)" % (repr(result),)
+        self.bytes_read += len(result)
+        self.buff = result
+        self.pos = 0
 
     def _wait(self):
         if not self.poll:
@@ -154,16 +233,32 @@ class ReaderWrapper(object):
         if self.closed:
             raise EOFError
 
-    def _read(self):
+    def _read(self, size):
         raise NotImplementedError
 
 class FileReader(ReaderWrapper):
-    def _read(self):
-        return self.file.read(1)
+    """Pipes, terminals and the like wrapped in Python 2 file objects
+    are read with os.read(), going around the stdio buffer, as a
+    plain read(size) would block until size bytes are available. Any
+    data already in that buffer is not seen, so such files must not
+    have been read from before being wrapped, unless they were opened
+    unbuffered. Regular files are read with read()."""
+
+    _bypass_buffer = None
+
+    def _read(self, size):
+        if hasattr(self.file, 'read1'):
+            return self.file.read1(size)
+        if self._bypass_buffer is None:
+            self._bypass_buffer = (isinstance(self.file, file)
+                                   and not stat.S_ISREG(os.fstat(self.file.fileno()).st_mode))
+        if self._bypass_buffer:
+            return os.read(self.file.fileno(), size)
+        return self.file.read(size)
 
 class SocketReader(ReaderWrapper):
-    def _read(self):
-        return self.file.recv(1)
+    def _read(self, size):
+        return self.file.recv(size)
 
 class ReIterator(object):
     """An iterator wrapper that provides lookahead through the peek
@@ -190,3 +285,107 @@ class ReIterator(object):
             return self._prefix[-1]
         except StopIteration:
             raise EOFError()
+
+_run_patterns = {}
+
+def _run_pattern(chars, negate=False):
+    key = (chars, negate)
+    if key not in _run_patterns:
+        _run_patterns[key] = re.compile("[%s%s]*" % (negate and '^' or '', re.escape(chars)))
+    return _run_patterns[key]
+
+class Cursor(object):
+    """A lookahead cursor over a sequence of string chunks.
+
+    The current chunk is kept together with an offset into it, so
+    that peek() and next() are simple index operations, and runs of
+    characters can be consumed with a single regular expression match
+    using take_while(), take_until() and skip_whitespace().
+
+    The chunks are taken from the read_chunk() method of a
+    ReaderWrapper, from a string (a single chunk), or from any other
+    iterator over strings."""
+
+    whitespace = ' \t\r\n'
+
+    def __init__(self, i):
+        if hasattr(i, 'read_chunk'):
+            self._read_chunk = i.read_chunk
+        elif isinstance(i, basestring):
+            self._read_chunk = iter((i,)).next
+        else:
+            self._read_chunk = iter(i).next
+        self.buff = ''
+        self.pos = 0
+
+    def __iter__(self):
+        return self
+
+    def _fill(self):
+        """Replaces the consumed buffer with the next non-empty
+        chunk. Returns False on EOF."""
+        chunk = ''
+        try:
+            while not chunk:
+                chunk = self._read_chunk()
+        except StopIteration:
+            return False
+        self.buff = chunk
+        self.pos = 0
+        return True
+
+    def next(self):
+        pos = self.pos
+        if pos >= len(self.buff):
+            if not self._fill():
+                raise StopIteration
+            pos = 0
+        self.pos = pos + 1
+        return self.buff[pos]
+
+    def peek(self):
+        if self.pos >= len(self.buff) and not self._fill():
+            raise EOFError()
+        return self.buff[self.pos]
+
+    def read_chunk(self):
+        """Consumes and returns the rest of the current chunk, or the
+        next chunk if it has all been consumed. Raises StopIteration on
+        EOF."""
+        if self.pos >= len(self.buff) and not self._fill():
+            raise StopIteration
+        result = self.buff
+        if self.pos:
+            result = result[self.pos:]
+        self.buff = ''
+        self.pos = 0
+        return result
+
+    def _take(self, pattern, keep=True):
+        parts = []
+        while True:
+            buff = self.buff
+            pos = self.pos
+            end = pattern.match(buff, pos).end()
+            if keep and end > pos:
+                parts.append(buff[pos:end])
+            self.pos = end
+            if end < len(buff) or not self._fill():
+                break
+        return ''.join(parts)
+
+    def take_while(self, chars):
+        """Consumes and returns the longest run of characters found
+        in chars. Returns what was found so far on EOF."""
+        return self._take(_run_pattern(chars))
+
+    def take_until(self, chars):
+        """Consumes and returns the longest run of characters not
+        found in chars. Returns what was found so far on EOF."""
+        return self._take(_run_pattern(chars, True))
+
+    def skip_whitespace(self):
+        """Consumes any whitespace and returns the next character
+        without consuming it, like peek()."""
+        self._take(_run_pattern(self.whitespace), False)
+        return self.peek()